@@ -41,11 +41,20 @@ class AwsEnvironment(CloudEnvironment):
         return True
     
     def upload_file_to_storage(self,file_name, storage_root, object_name,*args, **kwargs):
-        self.upload_file(
+        return self.upload_file(
             file_name=file_name, 
             bucket=storage_root, 
             object_name=object_name)
 
+    def delete_file_from_storage(self, bucket, object_name):
+        try:
+            self.storage.delete_object(
+                Bucket=bucket,
+                Key=object_name,
+            )
+        except ClientError as e:
+            logger.warning(f'Failed to delete file {object_name} from bucket {bucket}. Error: {e}')
+
     def copy_csv_storage_to_database(self, file, table, conn, *args, **kwargs):
         return super().copy_csv_storage_to_database(file, table, conn, *args, **kwargs)
     
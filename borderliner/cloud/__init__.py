@@ -192,6 +192,9 @@ class CloudEnvironment:
     
     def upload_file_to_storage(self,file_name, storage_root, object_name,*args, **kwargs):
         pass
+
+    def delete_file_from_storage(self, bucket, object_name):
+        pass
     
     def list_directory(self, directory_path,**kwargs):
         """
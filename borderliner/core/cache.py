@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+MANIFEST_FILE = 'manifest.json'
+
+class ExtractCache:
+    """
+    Local cache of extracted slice files.
+
+    Every entry is a directory named after the key, holding copies of the
+    slice files and a manifest. Entries expire after ttl seconds and the
+    least recently used ones are evicted when the cache grows past
+    max_size_mb.
+
+    config:
+        dir: cache directory (default .borderliner_cache)
+        ttl: seconds an entry stays valid (default 86400)
+        max_size_mb: size bound of the whole cache (default 10240)
+    """
+    def __init__(self,config:dict|bool=True) -> None:
+        if not isinstance(config,dict):
+            config = {}
+        self.logger = logger
+        self.cache_dir = config.get('dir','.borderliner_cache')
+        self.ttl = float(config.get('ttl',86400))
+        self.max_size = float(config.get('max_size_mb',10240)) * 1024 * 1024
+        os.makedirs(self.cache_dir,exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts)->str:
+        """Fingerprint of anything json serializable."""
+        payload = json.dumps(parts,default=str,sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_dir(self,key:str)->str:
+        return os.path.join(self.cache_dir,key)
+
+    def _read_manifest(self,entry_dir:str)->dict|None:
+        try:
+            with open(os.path.join(entry_dir,MANIFEST_FILE),'r') as f:
+                return json.load(f)
+        except (OSError,ValueError):
+            return None
+
+    def _write_manifest(self,entry_dir:str,manifest:dict):
+        tmp_file = os.path.join(entry_dir,f'{MANIFEST_FILE}.{uuid.uuid4().hex}')
+        with open(tmp_file,'w') as f:
+            json.dump(manifest,f)
+        os.replace(tmp_file,os.path.join(entry_dir,MANIFEST_FILE))
+
+    def _expired(self,manifest:dict)->bool:
+        return time.time() - manifest.get('created',0) > self.ttl
+
+    def restore(self,key:str)->dict|None:
+        """
+        Copies the cached files of key back to their original paths.
+        Returns the manifest on a hit, None on a miss.
+        """
+        entry_dir = self._entry_dir(key)
+        manifest = self._read_manifest(entry_dir)
+        if manifest is None:
+            return None
+        if self._expired(manifest):
+            self.logger.info(f'Extract cache entry {key[:12]} expired')
+            shutil.rmtree(entry_dir,ignore_errors=True)
+            return None
+        for filename in manifest['files']:
+            if os.path.dirname(filename):
+                os.makedirs(os.path.dirname(filename),exist_ok=True)
+            shutil.copy2(
+                os.path.join(entry_dir,os.path.basename(filename)),
+                filename)
+        manifest['last_access'] = time.time()
+        self._write_manifest(entry_dir,manifest)
+        self.logger.info(f'Extract cache hit {key[:12]}: {len(manifest["files"])} files')
+        return manifest
+
+    def store(self,key:str,files:list,rows:int=0):
+        """Copies files into a new entry for key, then enforces the size bound."""
+        tmp_dir = self._entry_dir(f'.tmp_{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        size = 0
+        for filename in files:
+            target = os.path.join(tmp_dir,os.path.basename(filename))
+            shutil.copy2(filename,target)
+            size += os.path.getsize(target)
+        now = time.time()
+        self._write_manifest(tmp_dir,{
+            'key':key,
+            'created':now,
+            'last_access':now,
+            'rows':rows,
+            'size':size,
+            'files':list(files)
+        })
+        entry_dir = self._entry_dir(key)
+        shutil.rmtree(entry_dir,ignore_errors=True)
+        try:
+            os.rename(tmp_dir,entry_dir)
+        except OSError:
+            # another run stored the same key meanwhile
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+        self.logger.info(f'Extract cache stored {key[:12]}: {len(files)} files, {size} bytes')
+        self.evict()
+
+    def evict(self):
+        """Drops expired entries, then least recently used ones over max_size_mb."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(name)
+            if name.startswith('.tmp_') or not os.path.isdir(entry_dir):
+                continue
+            manifest = self._read_manifest(entry_dir)
+            if manifest is None or self._expired(manifest):
+                shutil.rmtree(entry_dir,ignore_errors=True)
+                continue
+            entries.append(manifest)
+        entries.sort(key=lambda manifest: manifest.get('last_access',0))
+        total_size = sum(manifest.get('size',0) for manifest in entries)
+        while entries and total_size > self.max_size:
+            manifest = entries.pop(0)
+            self.logger.info(f'Extract cache evicting {manifest["key"][:12]}')
+            shutil.rmtree(self._entry_dir(manifest['key']),ignore_errors=True)
+            total_size -= manifest.get('size',0)
@@ -0,0 +1,160 @@
+import datetime
+import decimal
+import math
+import numbers
+import os
+import numpy
+import pandas
+from pandas.api import types as ptypes
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+_KEY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _key_text(value)->str:
+    """Text of one key value; see key_texts."""
+    if value is None or value is pandas.NaT or (not isinstance(value,str) and pandas.isna(value)):
+        return ''
+    if isinstance(value,(bool,numpy.bool_,str)):
+        return str(value)
+    if isinstance(value,(datetime.date,numpy.datetime64)):
+        value = pandas.Timestamp(value)
+        if value.tzinfo is not None:
+            value = value.tz_convert('UTC').tz_localize(None)
+        return value.strftime(_KEY_TIME_FORMAT)
+    if isinstance(value,(numbers.Number,decimal.Decimal)):
+        if math.isfinite(value) and value == int(value):
+            return str(int(value))
+        if isinstance(value,decimal.Decimal):
+            return format(value.normalize(),'f')
+    return str(value)
+
+def key_texts(series:pandas.Series)->pandas.Series:
+    """
+    Key column as normalized text: integral numbers without decimals
+    (1, 1.0 and Decimal('1.00') -> '1'), dates and timestamps as UTC
+    timestamps (date 2024-01-01 == timestamp 2024-01-01 00:00:00),
+    nulls as ''.
+    """
+    if ptypes.is_datetime64_any_dtype(series):
+        if getattr(series.dt,'tz',None) is not None:
+            series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+        return series.dt.strftime(_KEY_TIME_FORMAT).fillna('').astype(object)
+    if ptypes.is_integer_dtype(series) or ptypes.is_bool_dtype(series):
+        texts = series.astype(str).astype(object)
+        texts[series.isna().to_numpy()] = ''
+        return texts
+    return series.map(_key_text).astype(object)
+
+def key_hashes(df:pandas.DataFrame,key_columns:list)->numpy.ndarray:
+    """
+    uint64 hash of the conflict key of every row, over key_texts of the
+    key columns, so the same key read from the source and from the
+    target with different driver types hashes the same.
+    """
+    keys = pandas.DataFrame({
+        col:key_texts(df[col])
+        for col in key_columns
+    })
+    return pandas.util.hash_pandas_object(keys,index=False).to_numpy(dtype=numpy.uint64)
+
+class HashSnapshot:
+    """
+    (conflict key hash -> data md5) of every row in the target table.
+
+    Filled once per run from the target (or from a local cache file) and
+    kept up to date with the rows loaded, so chunks can be classified as
+    new, changed or unchanged without a round trip. Loaded rows go to a
+    dict merged into the snapshot once it outgrows it, so updates cost
+    the chunk, not the snapshot.
+    """
+    def __init__(self,key_columns:list,md5_label:str,cache_path:str=None) -> None:
+        self.logger = logger
+        self.key_columns = list(key_columns)
+        self.md5_label = md5_label
+        self.cache_path = cache_path
+        self.hashes = pandas.Series(dtype=object,index=pandas.Index([],dtype=numpy.uint64))
+        self.recent = {}
+
+    def __len__(self)->int:
+        self._merge()
+        return len(self.hashes)
+
+    def _set(self,keys:list,md5:list):
+        """Replaces the snapshot with (keys,md5) arrays, last one wins."""
+        hashes = pandas.Series(
+            numpy.concatenate(md5) if md5 else numpy.array([],dtype=object),
+            index=pandas.Index(numpy.concatenate(keys) if keys else [],dtype=numpy.uint64),
+            dtype=object)
+        self.hashes = hashes[~hashes.index.duplicated(keep='last')]
+        self.recent = {}
+
+    def _merge(self):
+        if not self.recent:
+            return
+        self._set(
+            [self.hashes.index.to_numpy(dtype=numpy.uint64),numpy.fromiter(self.recent.keys(),dtype=numpy.uint64,count=len(self.recent))],
+            [self.hashes.to_numpy(dtype=object),numpy.array(list(self.recent.values()),dtype=object)])
+
+    def _append(self,keys:numpy.ndarray,md5:numpy.ndarray):
+        self.recent.update(zip(keys.tolist(),md5.tolist()))
+        if len(self.recent) > len(self.hashes):
+            self._merge()
+
+    def fetch(self,backend,schema:str,table:str,chunk_size:int=500000):
+        """Reads the snapshot from the cache file when present, from the target otherwise."""
+        if self.cache_path and os.path.exists(self.cache_path):
+            cached = pandas.read_parquet(self.cache_path)
+            self.hashes = pandas.Series(
+                cached['md5'].to_numpy(dtype=object),
+                index=pandas.Index(cached['key'].to_numpy(dtype=numpy.uint64)),
+                dtype=object)
+            self.logger.info(f'CDC snapshot from {self.cache_path}: {len(self)} keys')
+            return
+        table_name = f'{schema}.{table}' if schema else table
+        columns = ', '.join(self.key_columns + [self.md5_label])
+        query = f'SELECT {columns} FROM {table_name}'
+        self.logger.info(f'Fetching CDC snapshot: {query}')
+        keys,md5 = [],[]
+        for df in backend.stream_query(query,chunk_size=chunk_size):
+            keys.append(key_hashes(df,self.key_columns))
+            md5.append(df[self.md5_label].to_numpy(dtype=object))
+        self._set(keys,md5)
+        self.logger.info(f'CDC snapshot: {len(self)} keys')
+
+    def classify(self,df:pandas.DataFrame)->tuple:
+        """Returns (new, changed) boolean masks over the rows of df."""
+        keys = key_hashes(df,self.key_columns)
+        stored = self.hashes.reindex(keys).to_numpy(dtype=object)
+        if self.recent:
+            recent = numpy.array([self.recent.get(key) for key in keys.tolist()],dtype=object)
+            stored = numpy.where(pandas.isna(recent),stored,recent)
+        new = pandas.isna(stored)
+        changed = ~new & (stored != df[self.md5_label].to_numpy(dtype=object))
+        return new,changed
+
+    def changed_rows(self,df:pandas.DataFrame)->pandas.DataFrame:
+        """Rows of df that are new or changed."""
+        new,changed = self.classify(df)
+        return df[new | changed]
+
+    def update(self,df:pandas.DataFrame):
+        """Records the rows of df as loaded."""
+        if len(df) == 0:
+            return
+        self._append(key_hashes(df,self.key_columns),df[self.md5_label].to_numpy(dtype=object))
+
+    def save(self):
+        if not self.cache_path:
+            return
+        self._merge()
+        if os.path.dirname(self.cache_path):
+            os.makedirs(os.path.dirname(self.cache_path),exist_ok=True)
+        tmp_path = f'{self.cache_path}.tmp'
+        pandas.DataFrame({
+            'key':self.hashes.index.to_numpy(dtype=numpy.uint64),
+            'md5':self.hashes.to_numpy(dtype=object)
+        }).to_parquet(tmp_path,index=False)
+        os.replace(tmp_path,self.cache_path)
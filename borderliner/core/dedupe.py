@@ -0,0 +1,82 @@
+import numpy
+import pandas
+
+from borderliner.core.cdc import key_hashes
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+DEDUPE_RULES = ('first','last','max')
+
+class Deduplicator:
+    """
+    Keeps one row per conflict key, so an upsert never touches a row
+    twice in one statement.
+
+    keep:
+        first: the first row seen for a key
+        last: the last row seen for a key
+        max: the row with the highest `column` (ties: the last one)
+    With across_batches, keys are remembered for the whole run (as
+    hashes): later chunks drop rows for keys already loaded with `first`,
+    or with a lower or equal `column` value with `max`. `last` needs no
+    memory, a later upsert overwrites the earlier one.
+    """
+    def __init__(self,key_columns:list,keep:str='last',column:str=None,across_batches:bool=True) -> None:
+        keep = str(keep).lower()
+        if keep not in DEDUPE_RULES:
+            raise ValueError(f'Invalid dedupe rule {keep}, use one of {list(DEDUPE_RULES)}')
+        if keep == 'max' and not column:
+            raise ValueError('dedupe keep: max needs a column')
+        self.logger = logger
+        self.key_columns = list(key_columns)
+        self.keep = keep
+        self.column = column
+        self.across_batches = across_batches and keep != 'last'
+        # key hash -> max value (max) or True (first)
+        self.seen = pandas.Series(dtype=object,index=pandas.Index([],dtype=numpy.uint64))
+        self.dropped_rows = 0
+
+    def _dedupe_batch(self,df:pandas.DataFrame)->pandas.DataFrame:
+        if self.keep == 'max':
+            ordered = df.sort_values(self.column,kind='stable',na_position='first')
+            return ordered.drop_duplicates(self.key_columns,keep='last').sort_index()
+        return df.drop_duplicates(self.key_columns,keep=self.keep)
+
+    def _drop_seen(self,df:pandas.DataFrame,keys:numpy.ndarray)->pandas.DataFrame:
+        if len(self.seen) == 0:
+            return df
+        if self.keep == 'first':
+            return df[~pandas.Index(keys).isin(self.seen.index)]
+        stored = self.seen.reindex(keys).to_numpy(dtype=object)
+        values = df[self.column].to_numpy(dtype=object)
+        keep = numpy.ones(len(df),dtype=bool)
+        known = ~pandas.isna(stored)
+        comparable = known & ~pandas.isna(values)
+        keep[known] = False
+        keep[comparable] = values[comparable] > stored[comparable]
+        return df[keep]
+
+    def _remember(self,df:pandas.DataFrame,keys:numpy.ndarray):
+        values = df[self.column].to_numpy(dtype=object) if self.keep == 'max' else True
+        update = pandas.Series(values,index=pandas.Index(keys,dtype=numpy.uint64),dtype=object)
+        # rows without a value can not be compared later
+        update = update[update.notna()]
+        self.seen = pandas.concat([self.seen[~self.seen.index.isin(update.index)],update])
+
+    def apply(self,df:pandas.DataFrame)->pandas.DataFrame:
+        rows = len(df)
+        df = self._dedupe_batch(df)
+        if self.across_batches and len(df):
+            keys = key_hashes(df,self.key_columns)
+            kept = self._drop_seen(df,keys)
+            if len(kept) != len(df):
+                keys = key_hashes(kept,self.key_columns)
+            df = kept
+            self._remember(df,keys)
+        dropped = rows - len(df)
+        if dropped:
+            self.dropped_rows += dropped
+            self.logger.info(f'Dedupe ({self.keep}): {dropped} duplicated rows dropped')
+        return df
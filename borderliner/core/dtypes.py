@@ -0,0 +1,85 @@
+import numpy
+import pandas
+from pandas.api import types as ptypes
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+STRING_DTYPE = 'string[pyarrow]'
+
+def _downcast_integer(series:pandas.Series)->pandas.Series:
+    if series.empty:
+        return series
+    return pandas.to_numeric(series,downcast='integer')
+
+def _downcast_float(series:pandas.Series)->pandas.Series:
+    """float64 -> float32 only when every value survives the round trip."""
+    if series.dtype != numpy.float64 or series.empty:
+        return series
+    downcast = series.astype(numpy.float32)
+    if numpy.array_equal(downcast.astype(numpy.float64).to_numpy(),series.to_numpy(),equal_nan=True):
+        return downcast
+    return series
+
+def _compact_strings(series:pandas.Series,category_ratio:float)->pandas.Series:
+    if ptypes.infer_dtype(series,skipna=True) != 'string':
+        return series
+    values = series.count()
+    if values == 0:
+        return series
+    if series.nunique(dropna=True) / values <= category_ratio:
+        return series.astype('category')
+    return series.astype(STRING_DTYPE)
+
+def optimize_dtypes(
+        df:pandas.DataFrame,
+        dtypes:dict=None,
+        category_ratio:float=0.5,
+        downcast_floats:bool=False,
+        auto:bool=True,
+        skip:list=[])->pandas.DataFrame:
+    """
+    Converts df to compact dtypes.
+
+    Columns in dtypes get that dtype. With auto, the others are
+    converted too: strings to categoricals when unique values are at most
+    category_ratio of the rows, to string[pyarrow] otherwise; integers to
+    the smallest integer type holding them; float64 to float32 when
+    lossless and downcast_floats is set.
+    """
+    dtypes = dtypes or {}
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if col in skip:
+            continue
+        series = df[col]
+        if col in dtypes:
+            df[col] = series.astype(dtypes[col])
+        elif not auto:
+            continue
+        elif series.dtype == object:
+            df[col] = _compact_strings(series,category_ratio)
+        elif ptypes.is_integer_dtype(series.dtype) and not ptypes.is_extension_array_dtype(series.dtype):
+            df[col] = _downcast_integer(series)
+        elif downcast_floats and ptypes.is_float_dtype(series.dtype):
+            df[col] = _downcast_float(series)
+    return df
+
+def to_python_dtypes(df:pandas.DataFrame)->pandas.DataFrame:
+    """
+    Turns categorical and arrow string columns back into object columns
+    with None for missing values, which is what the database drivers
+    expect to bind.
+    """
+    converted = None
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype,pandas.CategoricalDtype) or isinstance(dtype,pandas.StringDtype):
+            if converted is None:
+                converted = df.copy(deep=False)
+            series = df[col].astype(object)
+            converted[col] = series.where(series.notna(),None)
+    if converted is None:
+        return df
+    return converted
@@ -1,20 +1,13 @@
 import time
+import os
+from collections.abc import Iterator
 from .pipelines import (
-    Pipeline, PipelineConfig
+    Pipeline, PipelineConfig, gen_md5, CONTROL_COLUMNS_FLAG
 )
+from .streaming import run_stream
+from .slices import read_slice_file, write_slice_file
 import pandas
 import yaml
-import hashlib
-
-def gen_md5(df:pandas.DataFrame,ignore=[])->pandas.Series:
-    """Generate data md5"""
-    df = df.assign(concat=str(''))    
-    for col in df:
-        if col not in ignore:
-            df['concat'] += df[col].astype(str)
-    df['md5'] = df['concat'].apply(lambda x: hashlib.md5(x.encode()).hexdigest())
-    df = df.drop('concat', axis=1)
-    return df['md5']
 
 
 class EtlPipeline(Pipeline):
@@ -29,32 +22,47 @@ class EtlPipeline(Pipeline):
             if self.target.has_deltas:
                 self.source.dynamic_params = self.target.determine_deltas()
         self.source.extract()
+        if getattr(self.source,'spilled',False):
+            # memory_budget_mb passed, the extract went to slice files
+            self.config.dump_data_csv = True
+            if self.target:
+                self.target.dump_data_csv = True
         if self.config.generate_control_columns:
             self.logger.info('setting up control columns')
-            data_md5_label = self.get_control_columns_names().get('data_md5_label','brdr_data_md5')
-            extract_date_label = self.get_control_columns_names().get('extract_date_label','brdr_extract_date')
             if isinstance(self.source._data,pandas.DataFrame):
-                self.source._data[data_md5_label] = gen_md5(
-                        self.source._data,
-                        ignore=self.config.ignore_md5_fields
-                    )
-                self.source._data[extract_date_label] = str(time.strftime("%Y%m%d%H%M%S"))
+                self.source._data = self.add_control_columns(self.source._data)
                 
-            elif isinstance(self.source._data,list) or isinstance(self.source._data,type(iter([]))):
+            elif isinstance(self.source._data,list):
                 newlist = []
                 
                 for df in self.source._data:
-                    df[data_md5_label] = gen_md5(
-                        df,
-                        ignore=self.config.ignore_md5_fields
-                    )
-                    df[extract_date_label] = str(time.strftime("%Y%m%d%H%M%S"))
-                    newlist.append(df)
+                    newlist.append(self.add_control_columns(df))
                 self.source._data = newlist
+            elif isinstance(self.source._data,Iterator):
+                # lazy extract, keep it lazy
+                self.source._data = (self.add_control_columns(df) for df in self.source._data)
         else:
             self.logger.info('skipping control columns')
+        if hasattr(self.source,'compact_data'):
+            self.source.compact_data()
         
 
+    def add_control_columns(self,df:pandas.DataFrame)->pandas.DataFrame:
+        """Data hash and extract date; chunks already hashed in this run are left as is."""
+        data_md5_label = self.get_control_columns_names().get('data_md5_label','brdr_data_md5')
+        extract_date_label = self.get_control_columns_names().get('extract_date_label','brdr_extract_date')
+        if df.attrs.get(CONTROL_COLUMNS_FLAG,False):
+            return df
+        df[data_md5_label] = gen_md5(
+            df,
+            ignore=self.config.ignore_md5_fields,
+            algorithm=self.config.hash_algorithm,
+            workers=self.config.hash_workers
+        )
+        df[extract_date_label] = str(time.strftime("%Y%m%d%H%M%S"))
+        df.attrs[CONTROL_COLUMNS_FLAG] = True
+        return df
+
     def transform(self,*args,**kwargs):
         self.logger.warning('A middleware function is required to transform data in ETL class')
     
@@ -65,14 +73,119 @@ class EtlPipeline(Pipeline):
         self.target.load(self.source.data)
 
     
+    def prepare_chunk(self,df:pandas.DataFrame,*args,**kwargs)->pandas.DataFrame:
+        """Control columns, compact dtypes and transform for one streamed chunk."""
+        if self.config.generate_control_columns:
+            df = self.add_control_columns(df)
+        if hasattr(self.source,'compact_chunk'):
+            df = self.source.compact_chunk(df)
+        transformed_data = self.transform(df,*args, **kwargs)
+        if isinstance(transformed_data, pandas.DataFrame):
+            df = transformed_data
+        return df
+
+    def checkpoint_chunk(self,df:pandas.DataFrame,index:int):
+        """
+        Writes a transformed chunk as a slice file when checkpoint_slices
+        is set, uploading it like a dump. The load does not read it back.
+        """
+        if not self.config.checkpoint_slices:
+            return
+        filename = self.source.slice_path(
+            f'{self.source.pipeline_name}_checkpoint_{str(index).zfill(5)}',
+            'parquet')
+        write_slice_file(df,filename)
+        self.source.csv_chunks_files.append(filename)
+        if self.config.upload_dumps_to_storage:
+            self.env.upload_file_to_storage(
+                file_name=filename,
+                storage_root=self.env.storage_paths['storage_root'],
+                object_name=self.env.storage_paths['temp_files_dir']+'/'+os.path.basename(filename)
+            )
+
+    def loads_chunks(self)->bool:
+        return bool(self.target) and not self.kwargs.get('no_target',False)
+
+    def check_chunk_source(self):
+        if not hasattr(self.source,'iter_chunks'):
+            raise ValueError(
+                f'execution_mode {self.config.execution_mode} needs a database source, {type(self.source).__name__} can not be read in chunks')
+
+    def chunk_sink(self):
+        """Checkpoints (optional) and loads every prepared chunk."""
+        counter = {'index':0}
+        load = None
+        if self.loads_chunks():
+            load = self.target.load_chunk
+        def sink(df:pandas.DataFrame):
+            counter['index'] += 1
+            self.checkpoint_chunk(df,counter['index'])
+            if load:
+                load(df)
+        return sink
+
+    def run_direct(self, *args, **kwargs):
+        """
+        execution_mode: direct
+
+        Every chunk goes from the source to the target in memory:
+        extracted, transformed and loaded before the next is fetched,
+        without the parquet round trip of dump_data_csv.
+        """
+        self.check_chunk_source()
+        self.tracker.phase(f'Moving data from {self.source} to {self.target}')
+        if self.target and self.target.has_deltas:
+            self.source.dynamic_params = self.target.determine_deltas()
+        sink = self.chunk_sink()
+        if self.loads_chunks():
+            self.target.open_chunk_load()
+        try:
+            for df in self.source.iter_chunks():
+                sink(self.prepare_chunk(df,*args,**kwargs))
+        finally:
+            if self.loads_chunks():
+                self.target.close_chunk_load()
+        self.after_load()
+
+    def run_streaming(self, *args, **kwargs):
+        """
+        execution_mode: streaming
+
+        Extract, transform and load run at the same time on consecutive
+        chunks, joined by queues of stream_queue_depth chunks. Slices are
+        only written with checkpoint_slices.
+        """
+        self.check_chunk_source()
+        self.tracker.phase(f'Streaming from {self.source} to {self.target}')
+        if self.target and self.target.has_deltas:
+            self.source.dynamic_params = self.target.determine_deltas()
+        sink = self.chunk_sink()
+        if self.loads_chunks():
+            self.target.open_chunk_load()
+        try:
+            run_stream(
+                self.source.iter_chunks(),
+                [('transform',lambda df: self.prepare_chunk(df,*args,**kwargs))],
+                sink,
+                queue_depth=int(self.config.stream_queue_depth))
+        finally:
+            if self.loads_chunks():
+                self.target.close_chunk_load()
+        self.after_load()
+
     def run(self, *args, **kwargs):
+        match str(self.config.execution_mode).upper():
+            case 'STREAMING':
+                return self.run_streaming(*args, **kwargs)
+            case 'DIRECT':
+                return self.run_direct(*args, **kwargs)
         self.extract()
         print_upload_info = True
         #self.source._data = self.transform(self.source._data,*args, **kwargs)
         if self.config.dump_data_csv:
             for filename in self.source.csv_chunks_files:
                 #file_name, bucket, object_name=None
-                df = pandas.read_parquet(filename)
+                df = read_slice_file(filename)
                 # collect meta info
                 meta_info = self.extract_meta_info(df)
                 self.data_lineage['source_data'] = meta_info
@@ -83,12 +196,12 @@ class EtlPipeline(Pipeline):
                     # collect meta info
                     meta_info = self.extract_meta_info(df)
                     self.data_lineage['transformed_data'] = meta_info
-                df.to_parquet(filename)
+                write_slice_file(df,filename)
                 if self.config.upload_dumps_to_storage:
                     self.env.upload_file_to_storage(
                         file_name=filename,
                         storage_root=self.env.storage_paths['storage_root'],
-                        object_name=self.env.storage_paths['temp_files_dir']+'/'+filename
+                        object_name=self.env.storage_paths['temp_files_dir']+'/'+os.path.basename(filename)
                     )
                 else:
                     if print_upload_info:
@@ -120,13 +233,18 @@ class EtlPipeline(Pipeline):
 
             
         self.load_to_target()
+        self.after_load()
+
+    def after_load(self):
+        if self.target:
+            self.target.commit_load()
         # target flat file only
         if self.config.target.get('save_copy_in_storage',False):
             filename = self.target.get_filename()
             self.env.upload_file_to_storage(
                         file_name=filename,
                         storage_root=self.env.storage_paths['storage_root'],
-                        object_name=self.env.storage_paths['temp_files_dir']+'/'+filename
+                        object_name=self.env.storage_paths['temp_files_dir']+'/'+os.path.basename(filename)
                     )
         try:
             if self.env.manager:
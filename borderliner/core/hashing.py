@@ -0,0 +1,189 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import pandas
+import pyarrow as pa
+from pandas.api import types as ptypes
+
+HASH_ALGORITHMS = ('md5','xxh64','xxh128','hash64','hash128')
+# algorithms that digest a text per row in python
+PER_ROW_ALGORITHMS = ('md5','xxh64','xxh128')
+
+# hash_pandas_object keys (16 chars), one per 64 bit half of hash128
+_HASH_KEYS = ('brdr0123456789ab','brdr89abcdef0123')
+_FNV_PRIME = numpy.uint64(0x100000001b3)
+_HEX_BYTES = numpy.array([f'{i:02x}' for i in range(256)],dtype='<U2')
+_SEPARATOR = '\x1f'
+
+def _hex64(values:numpy.ndarray)->numpy.ndarray:
+    """uint64 array -> 16 char hex strings, without a python loop."""
+    octets = values.astype('>u8').view(numpy.uint8).reshape(-1,8)
+    return numpy.ascontiguousarray(_HEX_BYTES[octets]).view('<U16').ravel()
+
+def _concat_strings(df:pandas.DataFrame,columns:list,separator:str='')->pandas.Series:
+    concat = pandas.Series('',index=df.index,dtype=object)
+    for i,col in enumerate(columns):
+        if i and separator:
+            concat = concat + separator
+        concat = concat + df[col].astype(str).astype(object)
+    return concat
+
+def _row_digest(algorithm:str):
+    """text -> hex digest function of a per row algorithm."""
+    if algorithm == 'md5':
+        md5 = hashlib.md5
+        return lambda text: md5(text.encode()).hexdigest()
+    try:
+        import xxhash
+    except ImportError:
+        raise ImportError(f'hash_algorithm {algorithm} needs the xxhash package (pip install xxhash)')
+    digest = xxhash.xxh3_64_hexdigest if algorithm == 'xxh64' else xxhash.xxh3_128_hexdigest
+    return lambda text: digest(text.encode())
+
+def _row_texts(df:pandas.DataFrame,ignore:list,algorithm:str)->pandas.Series:
+    """
+    Text digested per row. For md5 it is the same text as the original
+    gen_md5: str() of every column in frame order. Its helper column was
+    added to the frame before the loop and ended up concatenated to
+    itself, so the text is written twice; kept for stored hashes to match.
+    """
+    if algorithm == 'md5':
+        columns = [col for col in df.columns if col not in ignore]
+        concat = _concat_strings(df,columns)
+        if 'concat' not in ignore:
+            concat = concat + concat
+        return concat
+    columns = sorted((col for col in df.columns if col not in ignore),key=str)
+    return _concat_strings(df,columns,_SEPARATOR)
+
+def _digest_texts(texts,algorithm:str)->list:
+    digest = _row_digest(algorithm)
+    return [digest(text) for text in texts]
+
+_pool:ProcessPoolExecutor = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+def _get_pool(workers:int)->ProcessPoolExecutor:
+    """Process pool shared by every hash call, rebuilt if workers changes."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn: forking a process that runs extract/load threads is unsafe
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+    return _pool
+
+def _digest_mapped_range(filename:str,start:int,stop:int,algorithm:str)->list:
+    """Worker: digests rows [start, stop) of the memory mapped text column."""
+    source = pa.memory_map(filename,'r')
+    try:
+        texts = pa.ipc.open_file(source).read_all().column(0).slice(start,stop - start)
+        return _digest_texts(texts.to_pylist(),algorithm)
+    finally:
+        source.close()
+
+def _digest_texts_parallel(texts:pandas.Series,algorithm:str,workers:int)->list:
+    """
+    Writes the row texts once as an arrow file in shared memory (/dev/shm
+    when present) and lets the pool digest row ranges of it through memory
+    maps, so no rows are pickled. Digests come back in row order.
+    """
+    table = pa.table({'text':pa.array(texts.to_numpy(),type=pa.large_string())})
+    scratch_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd,filename = tempfile.mkstemp(prefix='brdr_hash_',suffix='.arrow',dir=scratch_dir)
+    os.close(fd)
+    try:
+        with pa.OSFile(filename,'wb') as sink:
+            with pa.ipc.new_file(sink,table.schema) as writer:
+                writer.write_table(table)
+        del table
+        rows = len(texts)
+        parts = workers * 2
+        bounds = [rows * i // parts for i in range(parts + 1)]
+        pool = _get_pool(workers)
+        futures = [
+            pool.submit(_digest_mapped_range,filename,start,stop,algorithm)
+            for start,stop in zip(bounds[:-1],bounds[1:])
+            if stop > start
+        ]
+        digests = []
+        for future in futures:
+            digests.extend(future.result())
+        return digests
+    finally:
+        os.remove(filename)
+
+def _normalized(series:pandas.Series)->pandas.Series:
+    """Widens numpy numbers so downcast chunks hash like wide ones."""
+    if ptypes.is_extension_array_dtype(series.dtype):
+        return series
+    if ptypes.is_bool_dtype(series.dtype):
+        return series
+    if ptypes.is_unsigned_integer_dtype(series.dtype):
+        return series.astype(numpy.uint64)
+    if ptypes.is_integer_dtype(series.dtype):
+        return series.astype(numpy.int64)
+    if ptypes.is_float_dtype(series.dtype):
+        return series.astype(numpy.float64)
+    return series
+
+def _hash_frame64(df:pandas.DataFrame,columns:list,hash_key:str)->numpy.ndarray:
+    combined = numpy.zeros(len(df),dtype=numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        for col in columns:
+            hashed = pandas.util.hash_pandas_object(
+                _normalized(df[col]),
+                index=False,
+                hash_key=hash_key).to_numpy(dtype=numpy.uint64)
+            combined = (combined ^ hashed) * _FNV_PRIME
+    return combined
+
+def hash_rows(
+        df:pandas.DataFrame,
+        ignore:list=[],
+        algorithm:str='md5',
+        workers:int=1,
+        min_parallel_rows:int=200000)->pandas.Series:
+    """
+    Returns one hex digest per row of df, over every column not in ignore.
+
+    algorithm:
+        md5: compatible with the digests of earlier versions (slow)
+        xxh64, xxh128: xxhash over the row text (needs xxhash)
+        hash64, hash128: vectorized pandas hashing, no per row python
+    The non md5 algorithms take columns sorted by name, so the digest
+    does not depend on the select order.
+
+    With workers > 1, md5/xxh digests of chunks of at least
+    min_parallel_rows rows are spread over a process pool. Digests are
+    the same as with one worker.
+    """
+    algorithm = str(algorithm or 'md5').lower()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f'Invalid hash_algorithm {algorithm}, use one of {list(HASH_ALGORITHMS)}')
+    if algorithm in PER_ROW_ALGORITHMS:
+        texts = _row_texts(df,ignore,algorithm)
+        workers = int(workers or 1)
+        if workers > 1 and len(df) >= max(int(min_parallel_rows),workers):
+            digests = _digest_texts_parallel(texts,algorithm,workers)
+        else:
+            digests = _digest_texts(texts,algorithm)
+        return pandas.Series(digests,index=df.index,dtype=object)
+    columns = sorted((col for col in df.columns if col not in ignore),key=str)
+    match algorithm:
+        case 'hash64':
+            digests = _hex64(_hash_frame64(df,columns,_HASH_KEYS[0]))
+        case 'hash128':
+            digests = numpy.char.add(
+                _hex64(_hash_frame64(df,columns,_HASH_KEYS[0])),
+                _hex64(_hash_frame64(df,columns,_HASH_KEYS[1])))
+    return pandas.Series(digests.astype(object),index=df.index,dtype=object)
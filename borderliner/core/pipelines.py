@@ -6,7 +6,6 @@ import time
 from typing import Union, TextIO
 import pandas
 import yaml
-import hashlib
 import json
 
 from .exceptions import PipelineConfigException
@@ -24,6 +23,8 @@ from .targets import (
     PipelineTargetFlatFile,
     PipelineTargetReport
     )
+from borderliner.core.slices import is_slice_file
+from borderliner.core.hashing import hash_rows
 from borderliner.cloud import CloudEnvironment
 from borderliner.cloud.Aws import AwsEnvironment
 from borderliner.cloud.datacenter import DataCenterS3Environment
@@ -32,33 +33,37 @@ PIPELINE_TYPE_PROCESS = 'PROCESS_PIPELINE'
 PIPELINE_TYPE_EXTRACT = 'EXTRACT_PIPELINE'
 PIPELINE_TYPE_ETL = 'ETL_PIPELINE'
 
-def gen_md5(df:pandas.DataFrame,ignore=[])->pandas.Series:
-    """Generate data md5"""
-    df = df.assign(concat=str(''))    
-    for col in df:
-        if col not in ignore:
-            df['concat'] += df[col].astype(str)
-    df['md5'] = df['concat'].apply(lambda x: hashlib.md5(x.encode()).hexdigest())
-    df = df.drop('concat', axis=1)
-    return df['md5']
+def gen_md5(df:pandas.DataFrame,ignore=[],algorithm:str='md5',workers:int=1)->pandas.Series:
+    """Generate data md5 (or another hash_algorithm, see core.hashing)"""
+    return hash_rows(df,ignore=ignore,algorithm=algorithm,workers=workers)
 
 # logging
 from borderliner.core.logs import get_logger
 logger = get_logger()
 
+# DataFrame.attrs flag of chunks whose control columns this run computed
+CONTROL_COLUMNS_FLAG = 'brdr_control_columns'
 
 def set_control_columns(
         df:pandas.DataFrame,
         ignore_md5_fields:list=[],
-        control_columns_names:dict={})->pandas.DataFrame:
+        control_columns_names:dict={},
+        hash_algorithm:str='md5',
+        hash_workers:int=1)->pandas.DataFrame:
     data_md5_label = control_columns_names.get('data_md5','brdr_data_md5')
     extract_date_label = control_columns_names.get('extract_date','brdr_extract_date')
+    if df.attrs.get(CONTROL_COLUMNS_FLAG,False):
+        # already set for this chunk; a md5 column read from the source is recomputed
+        return df
     df[data_md5_label] = gen_md5(
                     df,
-                    ignore=ignore_md5_fields
+                    ignore=ignore_md5_fields,
+                    algorithm=hash_algorithm,
+                    workers=hash_workers
                 )
     #df[extract_date_label] = str(time.strftime("%Y%m%d%H%M%S"))
     df[extract_date_label] = str(time.strftime("%Y-%m-%d %H:%M:%S"))
+    df.attrs[CONTROL_COLUMNS_FLAG] = True
     return df
 
 class PhaseTracker:
@@ -116,6 +121,10 @@ class PipelineConfig:
         self.control_columns_names = {}
         self.ignore_md5_fields = []
         self.md5_ignore_fields = []
+        # md5 | xxh64 | xxh128 | hash64 | hash128
+        self.hash_algorithm = 'md5'
+        # processes hashing large chunks (md5/xxh only)
+        self.hash_workers = 1
         self.create_target_tables = False
         # cloud env
         self.storage = {}
@@ -124,6 +133,14 @@ class PipelineConfig:
         self.debug_query = False
         self.set_xcom = False
         self.xcom_variable = None
+        # batch | direct | streaming
+        self.execution_mode = 'batch'
+        self.stream_queue_depth = 2
+        # direct/streaming: keep transformed chunks as slice files
+        self.checkpoint_slices = False
+        # intermediate slices: parquet | arrow_ipc | feather
+        self.spill_format = 'parquet'
+        self.scratch_dir = ''
         
         self.alchemy_log_level = 'ERROR'
         try:
@@ -273,7 +290,9 @@ class Pipeline:
             return set_control_columns(
                 data,
                 self.config.ignore_md5_fields,
-                self.config.control_columns_names)
+                self.config.control_columns_names,
+                self.config.hash_algorithm,
+                self.config.hash_workers)
         return data
         
     def _clean_csv_chunk_files(self):
@@ -282,7 +301,7 @@ class Pipeline:
         #Alternatively, you can use the following code to remove CSV files using os.remove():
         self.source.csv_chunks_files = list(set(self.source.csv_chunks_files))
         for file in self.source.csv_chunks_files:
-            if file.endswith('.parquet'):
+            if is_slice_file(file) and os.path.exists(file):
                 os.remove(file)
         # self.csv_chunks_files = [file for file in self.csv_chunks_files if not file.endswith('.csv')]
 
@@ -418,7 +437,8 @@ class Pipeline:
                         pipeline_pid=self.pid,
                         csv_chunks_files=self.source.csv_chunks_files,
                         control_columns=self.config.generate_control_columns,
-                        control_columns_names=self.get_control_columns_names())
+                        control_columns_names=self.get_control_columns_names(),
+                        environment=self.env)
                     if self.config.create_target_tables:
                         if self.source is not None:
                             source_schema = self.source.inspect_source()                            
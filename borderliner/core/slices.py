@@ -0,0 +1,75 @@
+import os
+import pandas
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+SPILL_FORMATS = {
+    'parquet':'.parquet',
+    # uncompressed arrow ipc file, read back through a memory map
+    'arrow_ipc':'.arrow',
+    # arrow ipc file with lz4 buffers
+    'feather':'.feather',
+}
+
+def spill_extension(spill_format:str='parquet')->str:
+    spill_format = str(spill_format or 'parquet').lower()
+    if spill_format not in SPILL_FORMATS:
+        raise ValueError(f'Invalid spill_format {spill_format}, use one of {list(SPILL_FORMATS)}')
+    return SPILL_FORMATS[spill_format]
+
+def slice_format(filename:str)->str:
+    """Spill format of a slice file, from its extension."""
+    extension = os.path.splitext(str(filename))[1].lower()
+    for spill_format,format_extension in SPILL_FORMATS.items():
+        if extension == format_extension:
+            return spill_format
+    raise ValueError(f'Unknown slice file type {filename}')
+
+def is_slice_file(filename:str)->bool:
+    try:
+        slice_format(filename)
+    except ValueError:
+        return False
+    return True
+
+def _to_table(data:pandas.DataFrame|pa.RecordBatch|pa.Table)->pa.Table:
+    if isinstance(data,pa.Table):
+        return data
+    if isinstance(data,pa.RecordBatch):
+        return pa.Table.from_batches([data])
+    return pa.Table.from_pandas(data,preserve_index=False)
+
+def write_slice_file(data:pandas.DataFrame|pa.RecordBatch|pa.Table,filename:str):
+    """Writes a dataframe or arrow data in the format of the filename extension."""
+    match slice_format(filename):
+        case 'parquet':
+            if isinstance(data,pandas.DataFrame):
+                data.to_parquet(filename,index=False)
+            else:
+                pq.write_table(_to_table(data),filename)
+        case 'arrow_ipc':
+            table = _to_table(data)
+            with pa.OSFile(filename,'wb') as sink:
+                with pa.ipc.new_file(sink,table.schema) as writer:
+                    writer.write_table(table)
+        case 'feather':
+            feather.write_feather(_to_table(data),filename,compression='lz4')
+
+def read_slice_table(filename:str)->pa.Table:
+    """
+    Reads a slice file as an arrow table. Arrow IPC slices are memory
+    mapped, so buffers come straight from the page cache without a copy.
+    """
+    match slice_format(filename):
+        case 'parquet':
+            return pq.read_table(filename)
+        case 'arrow_ipc':
+            return pa.ipc.open_file(pa.memory_map(filename,'r')).read_all()
+        case 'feather':
+            return feather.read_table(filename,memory_map=True)
+
+def read_slice_file(filename:str)->pandas.DataFrame:
+    if slice_format(filename) == 'parquet':
+        return pandas.read_parquet(filename)
+    return read_slice_table(filename).to_pandas()
@@ -5,9 +5,12 @@ import os
 import re
 import pandas
 import logging
+import numbers
 import sys
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 # APACHE ARROW
-import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from pyarrow import Table, Schema
 import pyarrow as pa
@@ -27,7 +30,10 @@ import email.mime.audio
 import email.mime.image
 
 from borderliner.db.conn_abstract import DatabaseBackend
+from borderliner.core.dtypes import optimize_dtypes
+from borderliner.core.slices import spill_extension, write_slice_file
 from borderliner.cloud import CloudEnvironment
+from borderliner.core.cache import ExtractCache
 
 # logging
 from borderliner.core.logs import get_logger
@@ -80,6 +86,111 @@ def download_email_attachments(email, password, server, port, folder, protocol,
     mail.close()
     mail.logout()
 
+def _sql_literal(value)->str:
+    if isinstance(value,float) and value.is_integer():
+        # nullable int columns come back from pandas as float
+        return str(int(value))
+    if isinstance(value,numbers.Number):
+        return str(value)
+    return "'" + str(value).replace("'","''") + "'"
+
+def range_partition_predicates(column:str,lower,upper,num_partitions:int)->list:
+    """
+    Splits [lower, upper] into num_partitions ranges on column and returns
+    one WHERE predicate per range, Spark JDBC style: the first range also
+    takes NULLs and values below lower, the last one values above upper.
+    Works for numbers and dates/timestamps, other bounds raise ValueError.
+    """
+    if isinstance(lower,numbers.Number) != isinstance(upper,numbers.Number):
+        raise ValueError(
+            f'partition_column {column}: bounds {lower!r} and {upper!r} must both be numbers or both dates')
+    if not isinstance(lower,numbers.Number):
+        try:
+            lower = pandas.Timestamp(lower)
+            upper = pandas.Timestamp(upper)
+        except (ValueError,TypeError):
+            raise ValueError(
+                f'partition_column {column} must be a number or date/timestamp column, '
+                f'got bounds {lower!r} and {upper!r}')
+    if num_partitions <= 1 or upper <= lower:
+        return ['1=1']
+    stride = (upper - lower) / num_partitions
+    bounds = []
+    for i in range(1,num_partitions):
+        bound = lower + stride * i
+        if isinstance(lower,numbers.Integral):
+            bound = int(bound)
+        if bound not in bounds and lower < bound <= upper:
+            bounds.append(bound)
+    if not bounds:
+        return ['1=1']
+    bounds = [_sql_literal(bound) for bound in bounds]
+    predicates = [f'{column} < {bounds[0]} OR {column} IS NULL']
+    for low,high in zip(bounds[:-1],bounds[1:]):
+        predicates.append(f'{column} >= {low} AND {column} < {high}')
+    predicates.append(f'{column} >= {bounds[-1]}')
+    return predicates
+
+def render_batch_queries(template:str,items:pandas.DataFrame,batch_size:int)->list:
+    """
+    Renders template once per batch_size rows of items. Every iterate
+    column is replaced by the comma separated SQL literals of the batch,
+    for use in `WHERE key IN ({key})`; with a single column `{values}`
+    works too. With several columns each list is independent, so the
+    template must still match the exact combinations. NULLs never match
+    IN, so they are left out and batches without values are skipped.
+    """
+    queries = []
+    for start in range(0,len(items),batch_size):
+        batch = items.iloc[start:start + batch_size]
+        params = {}
+        for col in batch.columns:
+            values = batch[col].dropna().drop_duplicates().tolist()
+            if values:
+                params[col] = ', '.join(_sql_literal(value) for value in values)
+        if len(params) < len(batch.columns):
+            continue
+        if len(batch.columns) == 1:
+            params['values'] = params[batch.columns[0]]
+        queries.append(template.format(**params))
+    return queries
+
+def chunk_nbytes(df:pandas.DataFrame|pa.RecordBatch)->int:
+    """Memory held by a chunk, counting python objects (strings) too."""
+    if isinstance(df,pa.RecordBatch):
+        return df.nbytes
+    return int(df.memory_usage(index=True,deep=True).sum())
+
+class AdaptiveChunkSizer:
+    """
+    Picks the rows per chunk that keep a chunk near target_bytes.
+
+    Starts at initial_rows and, after every chunk seen, resizes from the
+    measured bytes per row (moving average, so one odd chunk does not
+    swing the size). Instances are callables, so they can be passed
+    where backends expect chunk_size.
+    """
+    def __init__(self,target_bytes:int,initial_rows:int=10000,min_rows:int=1000,max_rows:int=1000000) -> None:
+        self.target_bytes = max(int(target_bytes),1)
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.rows = min(max(int(initial_rows),min_rows),max_rows)
+        self.bytes_per_row = None
+
+    def observe(self,nbytes:int,rows:int):
+        if rows <= 0:
+            return
+        measured = nbytes / rows
+        if self.bytes_per_row is None:
+            self.bytes_per_row = measured
+        else:
+            self.bytes_per_row = 0.7 * self.bytes_per_row + 0.3 * measured
+        rows = int(self.target_bytes / max(self.bytes_per_row,1))
+        self.rows = min(max(rows,self.min_rows),self.max_rows)
+
+    def __call__(self)->int:
+        return self.rows
+
 class PipelineSource:
     def __init__(self,config:dict,*args,**kwargs) -> None:
         self.kwargs = kwargs
@@ -115,7 +226,7 @@ class PipelineSource:
         if len(self.csv_chunks_files) > 0:
             return self.csv_chunks_files
 
-        if isinstance(self._data, type(iter([]))):
+        if isinstance(self._data,Iterator):
             source_empty = False
         elif isinstance(self._data,list):
             if len(self._data) > 0:
@@ -241,6 +352,12 @@ class PipelineSourceDatabase(PipelineSource):
         self.deltas = {}
         self.primary_key = ()
 
+        self.chunk_sizer:AdaptiveChunkSizer = None
+        self.memory_budget = float(config.get('memory_budget_mb',0) or 0) * 1024 * 1024
+        self.held_bytes = 0
+        self.spilled = False
+        self._spill_lock = threading.Lock()
+
         self.configure()
     
     def inspect_source(self):
@@ -311,91 +428,202 @@ class PipelineSourceDatabase(PipelineSource):
         )
         self.queries = self.config['queries']
         self.logger.info(f'backend for {db_type} loaded')
-        self.engine = self.backend.get_engine()
+        parallelism = int(self.config.get('parallelism',1))
+        if parallelism > 1:
+            # one pooled connection per worker
+            self.engine = self.backend.get_engine(pool_size=parallelism)
+        else:
+            self.engine = self.backend.get_engine()
         self.connection = self.backend.get_connection()
 
     def populate_deltas(self):
         pass
 
-    def df_to_parquet(self, df:pandas.DataFrame,filename):
-        if self.control_columns_function:
-            df = self.control_columns_function(df) 
-        df.to_parquet(
-                    filename,
-                    index=False
-                )
-        self.metrics['total_rows'] += len(df)
-        self.csv_chunks_files.append(filename)
+    def read_query_chunks(self,query):
+        """
+        Returns an iterator of dataframes with at most chunk_size rows.
 
-    def populate_iteration_listARROW(self):
-        df = pandas.read_sql_query(
-            self.queries['iterate'],
-            self.engine
-        )
-        
-        total_cols = int(df.shape[1])
-        self._data = []
-        for col in df.columns:
-            df[col] = df[col].astype(str)
-
-        df = df.to_dict(orient='records')
-        slice_index = 1
-        for item in df:
-            self.logger.info(f'Extract by iteration: {item}')
-            query = self.queries['extract'].format(
-                **item
-            )
+        With stream_results enabled the rows come from a server-side
+        cursor (fetch_size rows per round trip), so the first chunk
+        arrives before the whole result set is scanned and memory
+        does not grow with the size of the extract.
+        """
+        if self.config.get('stream_results',False) or self.chunk_sizer:
+            return self.backend.stream_query(
+                query,
+                chunk_size=self.get_chunk_size(),
+                fetch_size=self.config.get('fetch_size',None))
+        return pandas.read_sql_query(
+                    query,
+                    self.engine,
+                    chunksize=self.chunk_size)
 
-            if self.config.get('use_pyarrow', False):
-                if self.chunk_size <= 0:
-                    self.chunk_size = 100000
-                # create a dataset from the SQL table
-                self.logger.info(f'Extracting using Apache Arrow: {self.chunk_size}')
-                connection = self.backend.get_engine().raw_connection()
-                data = ds.dataset(
-                    f'{self.backend.uri}::{query}',
-                    schema=pa.schema(connection.cursor().description),
-                    format='arrow',
-                    partitioning='hive'
-                )               
-                
-                for batch in data.to_batches(max_chunksize=self.chunk_size):
-                    # convert the batch to a pandas dataframe
-                    df = batch.to_pandas()
+    def read_query_batches(self,query):
+        """
+        Returns an iterator of pyarrow RecordBatches with at most
+        chunk_size rows, built straight from the driver (ADBC when
+        available, DB-API cursor otherwise) without going through pandas.
+        """
+        return self.backend.stream_record_batches(
+            query,
+            chunk_size=self.get_chunk_size(),
+            fetch_size=self.config.get('fetch_size',None))
 
-                    # apply any necessary transformations to the dataframe
-                    if self.control_columns_function:
-                        df = self.control_columns_function(df)
+    def read_copy_batches(self,query):
+        """
+        Returns an iterator of pyarrow RecordBatches extracted with
+        COPY ... TO STDOUT, for backends that support it (postgres).
+        """
+        if not hasattr(self.backend,'copy_query_batches'):
+            raise ValueError(f'copy_extract is not supported by {self.backend}')
+        return self.backend.copy_query_batches(query,chunk_size=self.get_chunk_size())
 
-                    # write the data to a Parquet file
-                    filename = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}.parquet'
-                    self.df_to_parquet(df,filename)   
-                    
+    def reads_arrow(self)->bool:
+        return bool(self.config.get('use_pyarrow',False) or self.config.get('copy_extract',False))
 
-                    # increment the slice index
-                    slice_index += 1
-            else:
-                data = pandas.read_sql_query(query, self.engine)
-                self.metrics['total_rows'] += len(data)
-
-                if self.kwargs.get('dump_data_csv', False):
-                    filename_csv = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}.csv'
-                    filename_parquet = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}.parquet'
-                    if self.control_columns_function:
-                        data = self.control_columns_function(data)
-                    if self.kwargs.get('dump_data_csv', False) == 'CSV':
-                        filename = filename_csv
-                        data.to_csv(filename_csv, index=False)
-                    else:
-                        filename = filename_parquet
-                        data.to_parquet(filename_parquet, index=False)
-                    self.csv_chunks_files.append(filename)
-                else:
-                    self._data.append(data)
+    def get_chunk_size(self):
+        """The adaptive sizer when chunk_memory_mb is set, chunk_size otherwise."""
+        if self.chunk_sizer:
+            return self.chunk_sizer
+        return self.chunk_size
+
+    def configure_chunk_sizer(self):
+        """
+        With chunk_memory_mb set, chunk_size (default 10000) is only the
+        first chunk; later chunks are sized from its bytes per row.
+        """
+        chunk_memory_mb = self.config.get('chunk_memory_mb',None)
+        if not chunk_memory_mb:
+            return
+        if self.chunk_size <= 0:
+            self.chunk_size = 10000
+        self.chunk_sizer = AdaptiveChunkSizer(
+            float(chunk_memory_mb) * 1024 * 1024,
+            initial_rows=self.chunk_size,
+            min_rows=int(self.config.get('min_chunk_size',1000)),
+            max_rows=int(self.config.get('max_chunk_size',1000000)))
+        self.logger.info(f'Adaptive chunk size: {chunk_memory_mb} MB per chunk')
+
+    def measure_chunks(self,chunks):
+        for df in chunks:
+            self.chunk_sizer.observe(chunk_nbytes(df),len(df))
+            yield df
+
+    def read_chunks(self,query):
+        """Arrow batches when use_pyarrow/copy_extract is set, dataframes otherwise."""
+        if self.config.get('copy_extract',False):
+            chunks = self.read_copy_batches(query)
+        elif self.config.get('use_pyarrow',False):
+            chunks = self.read_query_batches(query)
+        else:
+            chunks = self.read_query_chunks(query)
+        if self.chunk_sizer:
+            return self.measure_chunks(chunks)
+        return chunks
+
+    def is_dumping(self)->bool:
+        return bool(self.kwargs.get('dump_data_csv',False))
+
+    def hold_chunk(self,df:pandas.DataFrame)->bool:
+        """
+        Accounts df against memory_budget_mb. Returns True once the budget
+        is passed: from then on the extract spills to slice files, as with
+        dump_data_csv.
+        """
+        if not self.memory_budget:
+            return False
+        with self._spill_lock:
+            if self.is_dumping():
+                return True
+            self.held_bytes += chunk_nbytes(df)
+            if self.held_bytes > self.memory_budget:
+                self.logger.warning(
+                    f'Extract holds {self.held_bytes/1024/1024:.1f} MB, over memory_budget_mb; '
+                    'spilling to slice files')
+                self.kwargs['dump_data_csv'] = True
+                self.spilled = True
+                return True
+        return False
+
+    def slice_path(self,name:str,spill_format:str=None)->str:
+        """
+        Path of slice name in scratch_dir, with the extension of
+        spill_format (both from the pipeline config).
+        """
+        scratch_dir = getattr(self.pipeline_config,'scratch_dir','') or ''
+        if spill_format is None:
+            spill_format = getattr(self.pipeline_config,'spill_format','parquet')
+        if scratch_dir:
+            os.makedirs(scratch_dir,exist_ok=True)
+        return os.path.join(scratch_dir,f'{name}{spill_extension(spill_format)}')
+
+    def slice_filename(self,*parts)->str:
+        """Slice file name: <scratch_dir>/<pipeline>_slice_<part>_<part>..."""
+        parts = '_'.join(str(part).zfill(5) for part in parts)
+        return self.slice_path(f'{self.pipeline_name}_slice_{parts}')
+
+    def applies_control_columns(self)->bool:
+        if not self.control_columns_function:
+            return False
+        if self.pipeline_config is None:
+            return True
+        return bool(getattr(self.pipeline_config,'generate_control_columns',True))
+
+    def write_slice(self,df:pandas.DataFrame|pa.RecordBatch,filename)->int:
+        """
+        Applies control columns and writes df to filename.
+        Arrow batches are written as is unless control columns are needed.
+        Returns the number of rows written.
+        """
+        if isinstance(df,pa.RecordBatch):
+            if not self.applies_control_columns() and not self.optimizes_dtypes():
+                write_slice_file(df,filename)
+                return df.num_rows
+            df = df.to_pandas()
+        if self.control_columns_function:
+            df = self.control_columns_function(df) 
+        df = self.compact_chunk(df)
+        write_slice_file(df,filename)
+        return len(df)
+
+    def optimizes_dtypes(self)->bool:
+        return bool(self.config.get('optimize_dtypes',False) or self.config.get('dtypes',None))
 
-                slice_index += 1
+    def compact_chunk(self,df:pandas.DataFrame)->pandas.DataFrame:
+        """
+        Applies the `dtypes` map and, with optimize_dtypes, the automatic
+        compact dtypes (see borderliner.core.dtypes). Runs after control
+        columns, so the md5 is taken over the extracted values.
+        """
+        if not self.optimizes_dtypes():
+            return df
+        return optimize_dtypes(
+            df,
+            dtypes=self.config.get('dtypes',None),
+            category_ratio=float(self.config.get('category_ratio',0.5)),
+            downcast_floats=bool(self.config.get('downcast_floats',False)),
+            auto=bool(self.config.get('optimize_dtypes',False)))
+
+    def compact_data(self):
+        """compact_chunk over the in-memory extract (frame, list or iterator)."""
+        if not self.optimizes_dtypes() or self._data is None:
+            return
+        if isinstance(self._data,pandas.DataFrame):
+            self._data = self.compact_chunk(self._data)
+        elif isinstance(self._data,list):
+            self._data = [self.compact_chunk(df) for df in self._data]
+        else:
+            self._data = (self.compact_chunk(df) for df in self._data)
+
+    def df_to_parquet(self, df:pandas.DataFrame,filename):
+        self.metrics['total_rows'] += self.write_slice(df,filename)
+        self.csv_chunks_files.append(filename)
 
     def populate_iteration_list(self):
+        self.run_slice_groups(self.iteration_queries())
+
+    def iteration_queries(self)->list:
+        """Renders the extract query for every row of the iterate query."""
         self.logger.info('Populating iteration list')
         df = pandas.read_sql_query(
             self.queries['iterate'],
@@ -406,98 +634,278 @@ class PipelineSourceDatabase(PipelineSource):
         
         total_cols = int(df.shape[1])
         self._data = []
-        for col in df.columns:
-            df[col] = df[col].astype(str)
-        
-        df = df.to_dict(orient='records')
-        slice_index = 1
-        for item in df:
-            self.logger.info(f'Extract by iteration: {item}')
-            query = self.queries['extract'].format(
-                **item
-            )
-            if self.chunk_size <= 0:
-                self.chunk_size = 100000
+        if self.chunk_size <= 0:
+            self.chunk_size = 100000
+        batch_size = int(self.config.get('iterate_batch_size',1) or 1)
+        if batch_size > 1 and self.queries.get('extract_batch',None):
+            queries = render_batch_queries(
+                self.queries['extract_batch'],
+                df,
+                batch_size)
+            self.logger.info(f'Extract by iteration: {len(queries)} batches of up to {batch_size} items')
+        else:
+            for col in df.columns:
+                df[col] = df[col].astype(str)
+            queries = []
+            for item in df.to_dict(orient='records'):
+                self.logger.info(f'Extract by iteration: {item}')
+                queries.append(self.queries['extract'].format(**item))
+        for query in queries:
             try:
                 if self.pipeline_config.debug_query:
                     print(query)
             except:
                 pass
-            data = pandas.read_sql_query(
-                    query,
-                    self.engine,
-                    chunksize=self.chunk_size)
-            
-            
-            #self.metrics['total_rows'] += len(data)
-            if self.kwargs.get('dump_data_csv',False):
-                filename_parquet = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}.parquet'
-                if isinstance(data,pandas.DataFrame):
-                    df = data
-                    if len(df) > 0:
-                        self.df_to_parquet(df,filename_parquet)
-                    
-                else:
-                    iter_slice = 1
-                    for df in data:
-                        filename = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}_{str(iter_slice).zfill(5)}.parquet'
-                        if len(df) > 0:
-                            self.df_to_parquet(df,filename)                        
-                            iter_slice += 1
+        self.metrics['iterated_items'] = len(df)
+        return queries
+
+    def extract_slice_group(self,slice_index:int,query)->dict:
+        """
+        Runs one extract query and writes its chunks as slices
+        <pipeline>_slice_<slice_index>_<chunk>.
 
+        Touches no shared state and reads through its own pooled
+        connection, so several groups can run at the same time.
+        Returns {'files':[...],'data':[...],'rows':int}.
+        """
+        self.logger.info(f'Extracting slice group {slice_index}')
+        result = {'files':[],'data':[],'rows':0,'slice_index':slice_index}
+        for df in self.read_chunks(query):
+            if len(df) == 0:
+                continue
+            if self.is_dumping():
+                self.spill_slice_group(result)
+                filename = self.slice_filename(slice_index,len(result['files']) + 1)
+                result['rows'] += self.write_slice(df,filename)
+                result['files'].append(filename)
             else:
-                self._data.append(data)
-            slice_index += 1
+                if isinstance(df,pa.RecordBatch):
+                    df = df.to_pandas()
+                result['rows'] += len(df)
+                result['data'].append(df)
+                if self.hold_chunk(df):
+                    self.spill_slice_group(result)
+        return result
+
+    def iter_slice_groups(self,queries:list):
+        """Chunks of every query as dataframes, read one query after the other on demand."""
+        for index,query in enumerate(queries,start=1):
+            self.logger.info(f'Extracting slice group {index}')
+            for df in self.read_chunks(query):
+                if isinstance(df,pa.RecordBatch):
+                    df = df.to_pandas()
+                if len(df) == 0:
+                    continue
+                self.metrics['total_rows'] += len(df)
+                yield df
+
+    def spill_slice_group(self,result:dict):
+        """Moves the chunks a slice group holds in memory to slice files."""
+        while result['data']:
+            df = result['data'].pop(0)
+            filename = self.slice_filename(result['slice_index'],len(result['files']) + 1)
+            # rows were counted when the chunk was held
+            self.write_slice(df,filename)
+            result['files'].append(filename)
+
+    def run_slice_groups(self,queries:list):
+        """
+        Runs extract_slice_group for every query, `parallelism` of them
+        at a time, then merges files, data and row counts in query order
+        so slice order and naming do not depend on scheduling.
+        """
+        parallelism = max(int(self.config.get('parallelism',1)),1)
+        if not self.is_dumping() and not self.memory_budget and (parallelism <= 1 or len(queries) <= 1):
+            # nothing to write or account for: hand the chunks back lazily
+            self._data = self.iter_slice_groups(queries)
+            return
+        if self._data is None:
+            self._data = []
+        if parallelism > 1 and len(queries) > 1:
+            self.logger.info(f'Extracting {len(queries)} slice groups, {parallelism} at a time')
+            executor = ThreadPoolExecutor(max_workers=parallelism)
+            try:
+                futures = [
+                    executor.submit(self.extract_slice_group,index,query)
+                    for index,query in enumerate(queries,start=1)
+                ]
+                results = [future.result() for future in futures]
+            except Exception:
+                executor.shutdown(wait=True,cancel_futures=True)
+                raise
+            executor.shutdown(wait=True)
+        else:
+            results = [
+                self.extract_slice_group(index,query)
+                for index,query in enumerate(queries,start=1)
+            ]
+        if self.spilled:
+            for result in results:
+                self.spill_slice_group(result)
+            self._data = []
+        for result in results:
+            self.metrics['total_rows'] += result['rows']
+            self.csv_chunks_files.extend(result['files'])
+            self._data.extend(result['data'])
         
 
     def extract_by_iteration(self):
         self.populate_iteration_list()
 
+    def get_partition_bounds(self,query)->tuple:
+        """
+        Returns (lower_bound, upper_bound) from config, probing
+        MIN/MAX(partition_column) over the extract query when unset.
+        """
+        lower = self.config.get('lower_bound',None)
+        upper = self.config.get('upper_bound',None)
+        if lower is not None and upper is not None:
+            return lower,upper
+        column = self.config['partition_column']
+        probe = f'SELECT MIN({column}), MAX({column}) FROM ({query}) brdr_bounds'
+        self.logger.info(f'Probing partition bounds on {column}')
+        connection = self.backend.get_raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(probe)
+            min_value,max_value = cursor.fetchone()
+            cursor.close()
+        finally:
+            connection.close()
+        if lower is None:
+            lower = min_value
+        if upper is None:
+            upper = max_value
+        return lower,upper
+
+    def extract_by_partition(self):
+        self.run_slice_groups(self.partition_queries())
+
+    def partition_queries(self)->list:
+        """
+        Splits the extract query into num_partitions queries bounded on
+        partition_column, run as slice groups `parallelism` at a time
+        (one after the other without it).
+        """
+        from sqlalchemy import text
+        if self.chunk_size <= 0:
+            self.chunk_size = 100000
+        extract_query = self.get_query('extract')
+        query = str(extract_query).strip().rstrip(';')
+        column = self.config['partition_column']
+        parallelism = int(self.config.get('parallelism',1))
+        num_partitions = int(self.config.get('num_partitions',parallelism))
+        if num_partitions > 1 and parallelism <= 1:
+            self.logger.warning(f'{num_partitions} partitions on {column} run one after the other, set parallelism to run them at the same time')
+        lower,upper = self.get_partition_bounds(query)
+        if lower is None or upper is None:
+            self.logger.info(f'No values in {column}, extracting without partitions')
+            predicates = ['1=1']
+        else:
+            predicates = range_partition_predicates(column,lower,upper,num_partitions)
+        self.logger.info(f'Extracting {len(predicates)} partitions on {column} [{lower}, {upper}]')
+        queries = [
+            f'SELECT * FROM ({query}) brdr_part WHERE ({predicate})'
+            for predicate in predicates
+        ]
+        if not isinstance(extract_query,str):
+            # keep get_query's text() wrapping of queries with '%'
+            queries = [text(part) for part in queries]
+        return queries
+
+    def iter_chunks(self):
+        """
+        Yields the extract as dataframes, one chunk at a time and without
+        holding or dumping anything, for the streaming execution mode.
+        Iterate and partition queries are read one after the other.
+        """
+        self.configure_chunk_sizer()
+        if self.chunk_size <= 0:
+            self.chunk_size = 100000
+        if 'iterate' in self.queries:
+            queries = self.iteration_queries()
+        elif self.config.get('partition_column',None):
+            queries = self.partition_queries()
+        else:
+            queries = [self.get_query('extract')]
+        yield from self.iter_slice_groups(queries)
+
+    def get_extract_cache(self)->ExtractCache|None:
+        cache_config = self.config.get('extract_cache',False)
+        if not cache_config:
+            return None
+        if not self.kwargs.get('dump_data_csv',False):
+            self.logger.warning('extract_cache needs dump_data_csv, cache disabled.')
+            return None
+        return ExtractCache(cache_config)
+
+    def extract_cache_key(self)->str:
+        """
+        Fingerprint of everything that shapes the extracted slices:
+        backend, rendered queries, dynamic params and extract options.
+        """
+        backend = f'{type(self.backend).__name__}://{self.user}@{self.host}:{self.port}/{self.config.get("database")}'
+        queries = {
+            name:str(self.get_query(name))
+            for name in self.queries
+            if not str(name).endswith('_params')
+        }
+        options = {
+            key:value
+            for key,value in self.config.items()
+            if key not in ('username','password','queries','extract_cache')
+        }
+        control_columns = self.applies_control_columns()
+        return ExtractCache.make_key(
+            backend,
+            queries,
+            self.get_dynamic_params(),
+            options,
+            self.chunk_size,
+            control_columns,
+            getattr(self.pipeline_config,'hash_algorithm','md5'),
+            self.slice_path(''))
+
     def extract(self):
+        cache = self.get_extract_cache()
+        if cache is None:
+            return self.extract_from_source()
+        key = self.extract_cache_key()
+        manifest = cache.restore(key)
+        if manifest is not None:
+            self.csv_chunks_files.extend(manifest['files'])
+            self.metrics['total_rows'] += manifest.get('rows',0)
+            self.metrics['extract_cache_hit'] = True
+            return super().extract()
+        self.metrics['extract_cache_hit'] = False
+        self.extract_from_source()
+        cache.store(key,self.csv_chunks_files,self.metrics['total_rows'])
+
+    def extract_from_source(self):
+        self.configure_chunk_sizer()
+        streams = self.config.get('stream_results',False) or self.reads_arrow()
+        if streams and self.chunk_size <= 0:
+            self.chunk_size = 100000
         if 'iterate' in self.queries:
             self.extract_by_iteration()
             super().extract()
             return
+        if self.config.get('partition_column',None):
+            self.extract_by_partition()
+            return super().extract()
         
         if self.chunk_size > 0: 
-            
-
-            if self.config.get('use_pyarrow',False):
-                # create a dataset from the SQL table
-                self.logger.info(f'Extracting using Apache arrow: {self.chunk_size}')
-                query = self.get_query('extract')
-                data = ds.dataset(
-                    f'{self.backend.uri}::{query}',
-                    format='sql',
-                    batch_size=self.chunk_size
-                )
-
-                # create a scanner to read the data in batches
-                scanner = data.scanner()
+            self.logger.info(f'Extracting chunk size: {self.chunk_size}')
+            if self.reads_arrow():
+                self.logger.info('Extracting using Apache Arrow')
+            query = self.get_query('extract')
+            if self.is_dumping() or self.memory_budget:
+                self.run_slice_groups([query])
+            elif self.reads_arrow():
+                self._data = (batch.to_pandas() for batch in self.read_chunks(query))
             else:
-                self.logger.info(f'Extracting chunk size: {self.chunk_size}')
-                data = pandas.read_sql_query(
-                    self.get_query('extract'),
-                    self.engine,
-                    chunksize=self.chunk_size)
-                
-                slice_index = 1
-            if self.kwargs.get('dump_data_csv',False):
-                if self.config.get('use_pyarrow',False):
-                    # write the dataset to Parquet files in chunks                    
-                    for batch in data.to_batches():                        
-                        filename = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}.parquet'
-                        df = batch.to_pandas()                                        
-                        self.df_to_parquet(df,filename)                        
-                        slice_index += 1                        
-                else:
-                    for df in data:                        
-                        filename = f'{self.pipeline_name}_slice_{str(slice_index).zfill(5)}.parquet'
-                        self.df_to_parquet(df,filename)                        
-                        slice_index += 1
-                        
-            else:
-                self._data = data
+                # read_chunks feeds the adaptive chunk sizer
+                self._data = self.read_chunks(query)
         else:
             print(self.engine)
             data = pandas.read_sql_query(
@@ -505,14 +913,11 @@ class PipelineSourceDatabase(PipelineSource):
                 self.engine)
             self.metrics['total_rows'] += len(data)
             if self.kwargs.get('dump_data_csv',False):
-                filename = f'{self.pipeline_name}_slice_FULL.parquet'
+                filename = self.slice_path(f'{self.pipeline_name}_slice_FULL')
                 if self.control_columns_function:
                     
                     data = self.control_columns_function(data)                 
-                data.to_parquet(
-                    filename,
-                    index=False
-                )
+                write_slice_file(data,filename)
                 self.csv_chunks_files.append(filename)
             else:    
                 self._data = data
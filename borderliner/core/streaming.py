@@ -0,0 +1,101 @@
+import queue
+import threading
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+_END = object()
+
+class StageError(Exception):
+    pass
+
+class _Failure:
+    def __init__(self,stage:str,error:BaseException) -> None:
+        self.stage = stage
+        self.error = error
+
+def _put(q:queue.Queue,item,stop:threading.Event)->bool:
+    """Blocks while q is full (backpressure), gives up when stop is set."""
+    while not stop.is_set():
+        try:
+            q.put(item,timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q:queue.Queue,stop:threading.Event):
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return _END
+
+def run_stream(source,stages:list,sink,queue_depth:int=2):
+    """
+    Runs source -> stages -> sink as concurrent threads joined by queues
+    of queue_depth items, so every stage works on a different chunk.
+
+    source: iterable of items, consumed in its own thread
+    stages: list of (name, function) applied in order, one thread each
+    sink: function called with every item in the calling thread
+
+    A full queue blocks the stage feeding it, which bounds memory to about
+    queue_depth items per queue. The first exception stops every stage
+    and is raised as StageError.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=max(int(queue_depth),1)) for _ in range(len(stages) + 1)]
+
+    def produce():
+        out = queues[0]
+        try:
+            for item in source:
+                if not _put(out,item,stop):
+                    return
+            _put(out,_END,stop)
+        except BaseException as e:
+            _put(out,_Failure('extract',e),stop)
+        finally:
+            # releases the cursor when the stream stops early
+            close = getattr(source,'close',None)
+            if close:
+                close()
+
+    def transform(name,function,inq,outq):
+        while True:
+            item = _get(inq,stop)
+            if item is _END or isinstance(item,_Failure):
+                _put(outq,item,stop)
+                return
+            try:
+                item = function(item)
+            except BaseException as e:
+                _put(outq,_Failure(name,e),stop)
+                return
+            if not _put(outq,item,stop):
+                return
+
+    threads = [threading.Thread(target=produce,name='brdr-extract',daemon=True)]
+    for index,(name,function) in enumerate(stages):
+        threads.append(threading.Thread(
+            target=transform,
+            args=(name,function,queues[index],queues[index + 1]),
+            name=f'brdr-{name}',
+            daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            if isinstance(item,_Failure):
+                raise StageError(f'{item.stage} stage failed: {item.error}') from item.error
+            sink(item)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
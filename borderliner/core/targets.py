@@ -1,7 +1,10 @@
 
+import copy
 import importlib
 import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy
 import pandas
 import logging
 import sys
@@ -16,6 +19,11 @@ from borderliner.db.ibm_db2_lib import IbmDB2Backend
 from borderliner.db.mysql_lib import MySqlBackend
 from borderliner.db.mssql_lib import MsSqlBackend
 from borderliner.db.dbutils import get_column_type
+from borderliner.core.watermarks import WatermarkStore, make_watermark_store, merge_watermark
+from borderliner.core.dtypes import to_python_dtypes
+from borderliner.core.slices import read_slice_file
+from borderliner.core.cdc import HashSnapshot, key_hashes
+from borderliner.core.dedupe import Deduplicator
 # logging
 from borderliner.core.logs import get_logger
 logger = get_logger()
@@ -68,6 +76,8 @@ class PipelineTarget:
 
         self.has_deltas = False
 
+        self.env = kwargs.get('environment',None)
+
         self.configure()
     
     def get_active_connection(self):
@@ -136,6 +146,7 @@ class PipelineTarget:
             user=self.user,
             password=self.password,
             port=self.port,
+            environment=self.env,
             **self.config.get('backend_options', {}) # pass backend options from config
         )
         
@@ -153,20 +164,45 @@ class PipelineTarget:
             self.csv_chunks_files = list(set(self.csv_chunks_files))
             self.csv_chunks_files.sort()
             for filename in self.csv_chunks_files:
-                self.logger.info(f'reading parquet {filename}')
-                df = pandas.read_parquet(filename)
+                self.logger.info(f'reading slice {filename}')
+                df = read_slice_file(filename)
                 
-                self._data=df
+                self._data=to_python_dtypes(df)
                 self.save_data()
         else:
+            if isinstance(data,pandas.DataFrame):
+                data = to_python_dtypes(data)
+            elif isinstance(data,list):
+                data = [to_python_dtypes(df) for df in data]
+            elif data is not None:
+                data = (to_python_dtypes(df) for df in data)
             self._data=data
             self.save_data()
         if self.backend:
             self.metrics = self.backend.execution_metrics
 
+    def load_chunk(self,df:pandas.DataFrame):
+        """Saves one chunk, for the streaming execution mode."""
+        self._data = to_python_dtypes(df)
+        self.save_data()
+        if self.backend:
+            self.metrics = self.backend.execution_metrics
+
+    def open_chunk_load(self):
+        """Called once before the first load_chunk of a run."""
+        pass
+
+    def close_chunk_load(self):
+        """Called once after the last load_chunk of a run, also on failure."""
+        pass
+
     def save_data(self):
         pass
 
+    def commit_load(self):
+        """Called once the whole load succeeded."""
+        pass
+
     def determine_deltas(self)->dict:
         pass
 
@@ -176,45 +212,276 @@ class PipelineTargetDatabase(PipelineTarget):
         self.has_deltas = False
         if self.config.get('deltas',None):
             self.has_deltas = True
+        self.watermark_store:WatermarkStore = None
+        self.watermarks = {}
+        if self.has_deltas:
+            self.watermark_store = make_watermark_store(
+                self.config.get('watermarks',None),
+                self.engine)
+        self.cdc_snapshot:HashSnapshot = None
+        self.cdc_skipped = 0
+        self.deduplicator:Deduplicator = None
+        self.load_parallelism = max(int(self.config.get('load_parallelism',1) or 1),1)
+
+    def get_md5_label(self)->str:
+        return self.control_columns_names.get('data_md5_label','brdr_data_md5')
+
+    def get_cdc_snapshot(self)->HashSnapshot|None:
+        """
+        Target hash snapshot for `cdc`, fetched on first use. Needs
+        generate_control_columns and the UPSERT insertion method.
+        """
+        cdc_config = self.config.get('cdc',False)
+        if not cdc_config:
+            return None
+        if self.cdc_snapshot is not None:
+            return self.cdc_snapshot
+        if not isinstance(cdc_config,dict):
+            cdc_config = {}
+        insmethod = str(self.config.get('insertion_method','UPSERT')).upper()
+        if insmethod not in ('UPSERT','STAGED_MERGE') or not self.control_columns or not self.config.get('conflict_key',None):
+            self.logger.warning('cdc needs UPSERT, a conflict_key and control columns; cdc disabled.')
+            self.config['cdc'] = False
+            return None
+        self.cdc_snapshot = HashSnapshot(
+            self.get_conflict_key(),
+            self.get_md5_label(),
+            cache_path=cdc_config.get('cache',None))
+        self.cdc_snapshot.fetch(
+            self.backend,
+            self.config.get('schema',None),
+            self.config['table'],
+            chunk_size=int(cdc_config.get('fetch_size',500000)))
+        return self.cdc_snapshot
+
+    def get_conflict_key(self)->list:
+        conflict_key = self.config.get('conflict_key',None) or []
+        if isinstance(conflict_key,str):
+            conflict_key = [key.strip() for key in conflict_key.split(',')]
+        return list(conflict_key)
+
+    def get_deduplicator(self)->Deduplicator|None:
+        """
+        Deduplicator for `dedupe` (UPSERT only):
+
+            dedupe: last            # first | last
+            dedupe:
+              keep: max
+              column: updated_at
+              across_slices: true
+        """
+        dedupe_config = self.config.get('dedupe',None)
+        if not dedupe_config:
+            return None
+        if self.deduplicator is not None:
+            return self.deduplicator
+        if str(self.config.get('insertion_method','UPSERT')).upper() not in ('UPSERT','STAGED_MERGE'):
+            return None
+        if not isinstance(dedupe_config,dict):
+            dedupe_config = {'keep':dedupe_config if isinstance(dedupe_config,str) else 'last'}
+        self.deduplicator = Deduplicator(
+            self.get_conflict_key(),
+            keep=dedupe_config.get('keep','last'),
+            column=dedupe_config.get('column',None),
+            across_batches=bool(dedupe_config.get('across_slices',True)))
+        return self.deduplicator
+
+    def cdc_filter(self,df:pandas.DataFrame)->pandas.DataFrame:
+        """Drops the rows whose md5 matches the target snapshot."""
+        snapshot = self.get_cdc_snapshot()
+        if snapshot is None or self.get_md5_label() not in df.columns:
+            return df
+        changed = snapshot.changed_rows(df)
+        skipped = len(df) - len(changed)
+        self.cdc_skipped += skipped
+        self.logger.info(f'CDC: {len(changed)} new or changed rows, {skipped} unchanged')
+        return changed
+
+    def commit_load(self):
+        self.commit_watermarks()
+        if self.cdc_snapshot is not None:
+            self.cdc_snapshot.save()
+
+    def get_pipeline_name(self)->str:
+        return str(getattr(self.pipeline_config,'pipeline_name','') or self.pipeline_pid)
+
+    def get_delta_fields(self)->dict:
+        """Returns {dynamic_param_name: (function, column)} for the configured deltas."""
+        fields = {}
+        deltas: dict = self.config.get('deltas',{}) or {}
+        for key in deltas.keys():
+            delta = deltas[key]
+            delta_type = delta.get('type',None)
+            if delta_type not in ('max','min','count','sum','avg','distinct'):
+                raise ValueError(f'Invalid delta type {delta_type}')
+            fields[f'{delta_type}_{key}'] = (delta_type,key)
+        return fields
 
     def determine_deltas(self)->dict:
         '''
         Determine deltas between source and target tables.        
+
+        Stored watermarks are used when available, so only the first run
+        (or a run with new delta fields) aggregates the target table.
         '''
         self.logger.info('Determining deltas between source and target tables.')
         self.deltas = {}
-        deltas: dict = self.config.get('deltas',{})
-        fields = []
-        if deltas:
-            for key in deltas.keys():
-                delta = deltas[key]
-                delta_type = delta.get('type',None)
-                fn = ''
-                if delta_type == 'max':
-                    fn = 'max'
-                elif delta_type == 'min':
-                    fn = 'min'
-                elif delta_type == 'count':
-                    fn = 'count'
-                elif delta_type == 'sum':
-                    fn = 'sum'
-                elif delta_type == 'avg':
-                    fn = 'avg'
-                elif delta_type == 'distinct':
-                    fn = 'distinct'
-                else:
-                    raise ValueError(f'Invalid delta type {delta_type}')
-                fields.append(f'{fn}({key}) as {delta_type}_{key}')
-
-        if len(fields) == 0:                
-            sql_statement = f'select {",".join(fields)} from {self.config["target_table"]}'
-            self.logger.debug(f'Executing sql statement: {sql_statement}')
-            df = pandas.read_sql(sql_statement,self.engine)
-            self.deltas = df.to_dict(orient='records')[0]
-            self.logger.info(f'Deltas: {self.deltas}')
-            return self.deltas
-        
-        return {}
+        fields = self.get_delta_fields()
+        if len(fields) == 0:
+            return {}
+
+        if self.watermark_store:
+            stored = self.watermark_store.get(self.get_pipeline_name())
+            if all(name in stored for name in fields):
+                self.deltas = {name:stored[name] for name in fields}
+                self.logger.info(f'Deltas from watermark store: {self.deltas}')
+                return self.deltas
+
+        columns = [f'{fn}({key}) as {name}' for name,(fn,key) in fields.items()]
+        table = self.config['table']
+        if self.config.get('schema',None):
+            table = f'{self.config["schema"]}.{table}'
+        sql_statement = f'select {",".join(columns)} from {table}'
+        self.logger.debug(f'Executing sql statement: {sql_statement}')
+        df = pandas.read_sql(sql_statement,self.engine)
+        self.deltas = df.to_dict(orient='records')[0]
+        self.logger.info(f'Deltas: {self.deltas}')
+        return self.deltas
+
+    def track_watermarks(self,df:pandas.DataFrame):
+        """Folds max/min of the delta columns of a loaded chunk into self.watermarks."""
+        if not self.watermark_store or not isinstance(df,pandas.DataFrame) or df.empty:
+            return
+        for name,(fn,key) in self.get_delta_fields().items():
+            if fn not in ('max','min') or key not in df.columns:
+                continue
+            value = df[key].max() if fn == 'max' else df[key].min()
+            if pandas.isna(value):
+                continue
+            current = self.watermarks.get(name,None)
+            if current is None or (fn == 'max' and value > current) or (fn == 'min' and value < current):
+                self.watermarks[name] = value
+
+    def commit_watermarks(self):
+        """
+        Persists the watermarks seen in this run, after a successful load,
+        merged with the stored ones so they only move forward.
+        """
+        if not self.watermark_store or not self.watermarks:
+            return
+        stored = self.watermark_store.get(self.get_pipeline_name())
+        fields = self.get_delta_fields()
+        self.watermarks = {
+            name:merge_watermark(fields[name][0],stored.get(name,None),value)
+            for name,value in self.watermarks.items()
+        }
+        self.watermark_store.set(self.get_pipeline_name(),self.watermarks)
+        self.logger.info(f'Watermarks saved: {self.watermarks}')
+
+    def get_load_parallelism(self,insmethod:str)->int:
+        """
+        Workers for load_parallelism. Loads through a shared staging
+        table (staged upserts, redshift) and FULL_COPY stay serial.
+        """
+        if self.load_parallelism <= 1:
+            return 1
+        if insmethod not in ('UPSERT','BULK_INSERT','COPY','STAGED_MERGE'):
+            return 1
+        if self.use_staging_table() or isinstance(self.backend,RedshiftBackend):
+            return 1
+        if insmethod in ('UPSERT','STAGED_MERGE') and not self.get_conflict_key():
+            return 1
+        if not isinstance(self._data,(pandas.DataFrame,list)):
+            self.logger.warning('load_parallelism needs a DataFrame or a list of them, loading serially.')
+            return 1
+        return self.load_parallelism
+
+    def route_rows(self,df:pandas.DataFrame,workers:int)->list:
+        """
+        Splits df in one part per worker. Upserts are routed by conflict
+        key hash, so a key is always written by the same worker and two
+        workers never wait on each other's row locks.
+        """
+        conflict_key = self.get_conflict_key()
+        if conflict_key and all(key in df.columns for key in conflict_key):
+            buckets = key_hashes(df,conflict_key) % numpy.uint64(workers)
+        else:
+            buckets = numpy.arange(len(df)) % workers
+        return [df[buckets == worker] for worker in range(workers)]
+
+    def _load_worker(self,insmethod:str,df:pandas.DataFrame,conflict_action:str=None)->dict:
+        """
+        Loads df on a copy of the target with its own backend metrics,
+        through the same DataFrame path as a serial load, with the
+        conflict_action the serial load would have used. The copy uses
+        the engine, so it never shares the active connection.
+        """
+        worker = copy.copy(self)
+        if conflict_action is not None:
+            worker.config = {**self.config,'conflict_action':conflict_action}
+        worker.backend = copy.copy(self.backend)
+        worker.backend.execution_metrics = {key:0 for key in self.backend.execution_metrics}
+        worker.active_connection = self.engine
+        worker._data = df
+        match insmethod:
+            case 'UPSERT':
+                worker._do_upsert()
+            case 'BULK_INSERT':
+                worker._do_bulk_insert()
+            case 'COPY':
+                worker._do_copy()
+            case 'STAGED_MERGE':
+                worker._do_staged_merge()
+        return worker.backend.execution_metrics
+
+    def _merge_parts(self,insmethod:str,parts:list,conflict_action:str=None)->pandas.DataFrame:
+        """
+        One frame per worker. A key repeated across frames keeps the row
+        a serial load would have left: the last one on update, the first
+        one otherwise.
+        """
+        df = pandas.concat(parts,ignore_index=True)
+        if insmethod in ('UPSERT','STAGED_MERGE') and len(parts) > 1:
+            if conflict_action is None and insmethod == 'STAGED_MERGE':
+                conflict_action = 'update'
+            update = str(conflict_action).lower() == 'update'
+            df = df.drop_duplicates(self.get_conflict_key(),keep='last' if update else 'first')
+        return df
+
+    def _do_parallel_load(self,insmethod:str,workers:int):
+        """
+        Loads the current data on `workers` threads. Each one takes its
+        own pooled connections from the engine and commits its own
+        transactions.
+        """
+        conflict_action = self.config.get('conflict_action',None)
+        if insmethod == 'UPSERT' and isinstance(self._data,list):
+            # the serial upsert of a list always updates
+            conflict_action = 'update'
+        frames = self._data if isinstance(self._data,list) else [self._data]
+        frames = [df for df in frames if not df.empty]
+        if not frames:
+            return
+        parts = [[] for _ in range(workers)]
+        for df in frames:
+            for worker,part in enumerate(self.route_rows(df,workers)):
+                if not part.empty:
+                    parts[worker].append(part)
+        self.logger.info(
+            f'Parallel {insmethod} of {sum(len(df) for df in frames)} rows on {workers} workers')
+        with ThreadPoolExecutor(max_workers=workers,thread_name_prefix='brdr_load') as executor:
+            futures = [
+                executor.submit(
+                    self._load_worker,
+                    insmethod,
+                    self._merge_parts(insmethod,part,conflict_action),
+                    conflict_action)
+                for part in parts if part
+            ]
+            results = [future.result() for future in futures]
+        for metrics in results:
+            for key,value in metrics.items():
+                self.backend.execution_metrics[key] = self.backend.execution_metrics.get(key,0) + value
 
     def use_staging_table(self)->bool|str:
         return self.config.get('staging_schema',False)
@@ -378,8 +645,8 @@ class PipelineTargetDatabase(PipelineTarget):
             self.active_connection = self.get_active_connection()
             #self.active_connection.connect()
             for filename in self.csv_chunks_files:
-                self.logger.info(f'reading parquet {filename}')
-                df = pandas.read_parquet(filename)                
+                self.logger.info(f'reading slice {filename}')
+                df = to_python_dtypes(read_slice_file(filename))
                 # Replace NaN values with None
                 # Replace NaN values with None
                 df.replace({pandas.NA: None,'NaN':None}, inplace=True)
@@ -388,11 +655,72 @@ class PipelineTargetDatabase(PipelineTarget):
                 self.save_data()
             self.active_connection.close()
         else:
-            self._data=data
-            self.save_data()
+            if data is not None and not isinstance(data,(pandas.DataFrame,list)):
+                # lazy extract: load chunk by chunk as they are read
+                self.active_connection = self.get_active_connection()
+                try:
+                    for df in data:
+                        self._data = to_python_dtypes(df)
+                        self.save_data()
+                finally:
+                    self.active_connection.close()
+            else:
+                if isinstance(data,pandas.DataFrame):
+                    data = to_python_dtypes(data)
+                elif isinstance(data,list):
+                    data = [to_python_dtypes(df) for df in data]
+                self._data=data
+                self.save_data()
         if self.backend:
             self.metrics = self.backend.execution_metrics
     
+    def open_chunk_load(self):
+        """One connection for every chunk of a direct/streaming run."""
+        self.active_connection = self.get_active_connection()
+
+    def close_chunk_load(self):
+        if self.active_connection is not None:
+            self.active_connection.close()
+            self.active_connection = None
+
+    def _do_copy(self):
+        """COPY FROM STDIN, for backends that support it (postgres)."""
+        if not hasattr(self.backend,'copy_insert'):
+            self.logger.warning(f'COPY is not supported by {self.backend}, using BULK_INSERT.')
+            return self._do_bulk_insert()
+        frames = self._data if isinstance(self._data,list) else [self._data]
+        connection = self.engine.raw_connection()
+        try:
+            for df in frames:
+                self.logger.info(f'Insertion Method: COPY for {len(df)} rows')
+                self.backend.copy_insert(
+                    connection,
+                    df,
+                    self.config.get('schema',None),
+                    self.config['table'])
+        finally:
+            connection.close()
+
+    def _do_staged_merge(self):
+        """#temp staging table + one MERGE per chunk, for backends that support it (mssql)."""
+        if not hasattr(self.backend,'staged_merge'):
+            self.logger.warning(f'STAGED_MERGE is not supported by {self.backend}, using UPSERT.')
+            return self._do_upsert()
+        frames = self._data if isinstance(self._data,list) else [self._data]
+        connection = self.engine.raw_connection()
+        try:
+            for df in frames:
+                self.logger.info(f'Insertion Method: STAGED_MERGE for {len(df)} rows')
+                self.backend.staged_merge(
+                    connection,
+                    df,
+                    self.config.get('schema',None),
+                    self.config['table'],
+                    conflict_key=self.get_conflict_key(),
+                    conflict_action=self.config.get('conflict_action','update'))
+        finally:
+            connection.close()
+
     def _do_full_copy(self):
         # refresh engine
         #self.engine = self.backend.get_engine()
@@ -400,14 +728,49 @@ class PipelineTargetDatabase(PipelineTarget):
         return self._do_bulk_insert()
 
     def save_data(self):
+        deduplicator = self.get_deduplicator()
+        if deduplicator is not None:
+            if isinstance(self._data,pandas.DataFrame):
+                self._data = deduplicator.apply(self._data)
+            elif isinstance(self._data,list):
+                self._data = [deduplicator.apply(df) for df in self._data]
+            self.backend.execution_metrics['duplicate_rows'] = deduplicator.dropped_rows
+        if self.get_cdc_snapshot() is not None:
+            if isinstance(self._data,pandas.DataFrame):
+                self._data = self.cdc_filter(self._data)
+            elif isinstance(self._data,list):
+                self._data = [self.cdc_filter(df) for df in self._data]
+            self.backend.execution_metrics['unchanged_rows'] = self.cdc_skipped
+        if deduplicator is not None or self.cdc_snapshot is not None:
+            # nothing left to send
+            if isinstance(self._data,pandas.DataFrame) and self._data.empty:
+                self._data = []
+            elif isinstance(self._data,list):
+                self._data = [df for df in self._data if not df.empty]
         insmethod = self.config.get('insertion_method','UPSERT')
+        workers = self.get_load_parallelism(insmethod.upper())
         match insmethod.upper():
+            case _ if workers > 1:
+                self._do_parallel_load(insmethod.upper(),workers)
             case 'UPSERT':
                 self._do_upsert()
             case 'BULK_INSERT':
                 self._do_bulk_insert()
             case 'FULL_COPY':
                 self._do_full_copy()
+            case 'COPY':
+                self._do_copy()
+            case 'STAGED_MERGE':
+                self._do_staged_merge()
+        if isinstance(self._data,list):
+            for df in self._data:
+                self.track_watermarks(df)
+                if self.cdc_snapshot is not None:
+                    self.cdc_snapshot.update(df)
+        else:
+            self.track_watermarks(self._data)
+            if self.cdc_snapshot is not None and isinstance(self._data,pandas.DataFrame):
+                self.cdc_snapshot.update(self._data)
         
         
 
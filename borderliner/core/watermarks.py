@@ -0,0 +1,165 @@
+import datetime as dt
+import numbers
+import os
+import sqlite3
+from datetime import datetime
+import numpy
+import pandas
+from sqlalchemy import MetaData, Table, Column, String, DateTime, Text
+from sqlalchemy.engine import Engine
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+class WatermarkStore:
+    """
+    Persists high-water marks per pipeline.
+
+    Values are kept as strings, they are only used to render the
+    extract query through dynamic_params.
+    """
+    def __init__(self,*args,**kwargs) -> None:
+        self.logger = logger
+
+    def get(self,pipeline_name:str)->dict:
+        raise NotImplementedError()
+
+    def set(self,pipeline_name:str,watermarks:dict):
+        """Replaces the watermarks of pipeline_name in one transaction."""
+        raise NotImplementedError()
+
+
+class SQLiteWatermarkStore(WatermarkStore):
+    """Watermarks in a local sqlite file."""
+    def __init__(self,path:str='borderliner_watermarks.db',*args,**kwargs) -> None:
+        super().__init__(*args,**kwargs)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS brdr_watermarks (
+                    pipeline_name TEXT NOT NULL,
+                    watermark_name TEXT NOT NULL,
+                    watermark_value TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (pipeline_name, watermark_name)
+                )''')
+        conn.close()
+
+    def get(self,pipeline_name:str)->dict:
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute(
+                'SELECT watermark_name, watermark_value FROM brdr_watermarks WHERE pipeline_name = ?',
+                (pipeline_name,)).fetchall()
+        finally:
+            conn.close()
+        return {name:value for name,value in rows}
+
+    def set(self,pipeline_name:str,watermarks:dict):
+        updated_at = datetime.now().isoformat()
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO brdr_watermarks VALUES (?, ?, ?, ?)',
+                    [
+                        (pipeline_name,name,None if value is None else str(value),updated_at)
+                        for name,value in watermarks.items()
+                    ])
+        finally:
+            conn.close()
+
+
+class DatabaseWatermarkStore(WatermarkStore):
+    """Watermarks in a control table of the target database."""
+    def __init__(self,engine:Engine,schema:str=None,table:str='brdr_watermarks',*args,**kwargs) -> None:
+        super().__init__(*args,**kwargs)
+        self.engine = engine
+        self.table = Table(
+            table,
+            MetaData(schema=schema),
+            Column('pipeline_name',String(255),primary_key=True),
+            Column('watermark_name',String(255),primary_key=True),
+            Column('watermark_value',Text),
+            Column('updated_at',DateTime))
+        self.table.create(self.engine,checkfirst=True)
+
+    def get(self,pipeline_name:str)->dict:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                self.table.select().where(self.table.c.pipeline_name == pipeline_name)
+            ).fetchall()
+        return {row.watermark_name:row.watermark_value for row in rows}
+
+    def set(self,pipeline_name:str,watermarks:dict):
+        updated_at = datetime.now()
+        with self.engine.begin() as conn:
+            conn.execute(
+                self.table.delete().where(
+                    self.table.c.pipeline_name == pipeline_name,
+                    self.table.c.watermark_name.in_(list(watermarks.keys()))))
+            conn.execute(self.table.insert(),[
+                {
+                    'pipeline_name':pipeline_name,
+                    'watermark_name':name,
+                    'watermark_value':None if value is None else str(value),
+                    'updated_at':updated_at
+                }
+                for name,value in watermarks.items()
+            ])
+
+
+def merge_watermark(fn:str,stored,value):
+    """
+    Watermark to keep of the stored one (text) and the one seen in this
+    run: the larger for max deltas, the smaller for min ones, so a run of
+    late arriving rows never moves it back. A stored value that does not
+    parse as the type of value is replaced.
+    """
+    if stored is None:
+        return value
+    try:
+        if isinstance(value,(dt.date,numpy.datetime64)):
+            current,seen = pandas.Timestamp(stored),pandas.Timestamp(value)
+            if (current.tzinfo is None) != (seen.tzinfo is None):
+                # naive values are taken as UTC
+                current,seen = [
+                    ts.tz_localize('UTC') if ts.tzinfo is None else ts
+                    for ts in (current,seen)
+                ]
+        elif isinstance(value,numbers.Number):
+            current,seen = float(stored),float(value)
+        else:
+            current,seen = str(stored),str(value)
+        keep_stored = current > seen if fn == 'max' else current < seen
+    except (ValueError,TypeError):
+        return value
+    return stored if keep_stored else value
+
+def make_watermark_store(config:dict,engine:Engine=None)->WatermarkStore|None:
+    """
+    Builds the store described by the target `watermarks` config:
+
+        watermarks:
+          store: sqlite    # or table
+          path: borderliner_watermarks.db
+          schema: control  # table store only
+          table: brdr_watermarks
+    """
+    if not config:
+        return None
+    if not isinstance(config,dict):
+        config = {}
+    store = str(config.get('store','sqlite')).upper()
+    match store:
+        case 'SQLITE':
+            return SQLiteWatermarkStore(config.get('path','borderliner_watermarks.db'))
+        case 'TABLE':
+            return DatabaseWatermarkStore(
+                engine,
+                schema=config.get('schema',None),
+                table=config.get('table','brdr_watermarks'))
+    raise ValueError(f'Invalid watermark store {store}')
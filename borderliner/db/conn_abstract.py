@@ -6,6 +6,7 @@ from sqlalchemy import create_engine, MetaData, Table
 import os
 import warnings
 import pandas
+import pyarrow as pa
 
 import sys
 import inspect
@@ -17,6 +18,8 @@ from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy import create_engine, exc, text
 from sqlalchemy.engine import Engine
 
+from borderliner.db.schema_cache import SchemaCache
+
 # logging
 from borderliner.core.logs import get_logger
 logger = get_logger()
@@ -92,6 +95,12 @@ class DatabaseBackend:
         self.create_table = False
         # Define if the count of rows should be used for metrics
         self.use_count_for_metrics = False
+        self.schema_cache:SchemaCache = None
+        # bind parameters per statement of multi-row MERGEs
+        self.max_bind_params = int(kwargs.get('max_bind_params',2000))
+        self.max_merge_rows = int(kwargs.get('max_merge_rows',1000))
+        # cloud environment of the pipeline, for loads through storage
+        self.environment = kwargs.get('environment',None)
     
     def extract_values(self,values):
         t = []
@@ -102,6 +111,19 @@ class DatabaseBackend:
             t.append(xx)
         return tuple(t)
 
+    def get_schema_cache(self)->SchemaCache:
+        """
+        Table metadata cache of this backend, shared by every chunk of the
+        run. Backend option schema_cache_path persists it across runs.
+        """
+        if self.schema_cache is None:
+            if self.engine is None:
+                self.get_engine()
+            self.schema_cache = SchemaCache(
+                self.engine,
+                persist_path=self.kwargs.get('schema_cache_path',None))
+        return self.schema_cache
+
     def inspect_table(self,schema:str,table_name:str):
         source_metadata = MetaData()
         source_table_reflected = Table(
@@ -189,6 +211,88 @@ class DatabaseBackend:
     def record_exists(self,*args,**kwargs)->bool:
         pass
 
+    def get_raw_connection(self):
+        """
+        Returns a DB-API connection checked out from the backend engine.
+        """
+        if not isinstance(self.engine,Engine):
+            self.get_engine()
+        return self.engine.raw_connection()
+
+    def get_streaming_cursor(self,connection,fetch_size:int=10000):
+        """
+        Returns a cursor suitable for streaming large result sets.
+
+        Rows are read with fetchmany(fetch_size); the default
+        implementation also sets the DB-API arraysize to match. Backends
+        with real server-side cursors should override it.
+        """
+        cursor = connection.cursor()
+        cursor.arraysize = fetch_size
+        return cursor
+
+    def _fetch_row_blocks(self,query,chunk_size:int=100000,fetch_size:int=None):
+        """
+        Executes query on a streaming cursor and yields
+        (column_names, rows) blocks of at most chunk_size rows.
+        Rows are fetched fetch_size at a time (chunk_size when not set)
+        and regrouped into blocks. chunk_size may be a callable, read
+        again before every block.
+        """
+        fetch_size = int(fetch_size) if fetch_size else None
+        connection = self.get_raw_connection()
+        cursor = self.get_streaming_cursor(connection,fetch_size or resolve_chunk_size(chunk_size))
+        try:
+            cursor.execute(str(query))
+            columns = None
+            pending = []
+            while True:
+                rows = cursor.fetchmany(fetch_size or resolve_chunk_size(chunk_size))
+                if columns is None:
+                    # named (server-side) cursors describe the result only after the first fetch
+                    columns = [col[0] for col in cursor.description or []]
+                pending.extend(rows)
+                block_size = resolve_chunk_size(chunk_size)
+                while pending and (len(pending) >= block_size or not rows):
+                    yield columns,pending[:block_size]
+                    pending = pending[block_size:]
+                    block_size = resolve_chunk_size(chunk_size)
+                if not rows:
+                    break
+        finally:
+            cursor.close()
+            connection.rollback()
+            connection.close()
+
+    def stream_query(self,query,chunk_size:int=100000,fetch_size:int=None):
+        """
+        Executes query and yields dataframes of at most chunk_size rows.
+
+        Rows are fetched through get_streaming_cursor, so only one chunk
+        is held in client memory at a time.
+
+        params:
+            query: str or sqlalchemy text clause
+            chunk_size: max rows per yielded dataframe, or a callable
+                returning it (adaptive sizing)
+            fetch_size: rows per driver round trip, defaults to chunk_size
+        """
+        for columns,rows in self._fetch_row_blocks(query,chunk_size,fetch_size):
+            if not isinstance(rows[0],tuple):
+                rows = [tuple(row) for row in rows]
+            yield pandas.DataFrame.from_records(
+                rows,
+                columns=columns,
+                coerce_float=True)
+
+    def stream_record_batches(self,query,chunk_size:int=100000,fetch_size:int=None):
+        """
+        Same as stream_query, but yields pyarrow RecordBatches built
+        column by column from the cursor rows, without pandas.
+        """
+        for columns,rows in self._fetch_row_blocks(query,chunk_size,fetch_size):
+            yield rows_to_record_batch(rows,columns)
+
     def collect_metrics(self):
         raise Exception('Your connector does not implement metrics collection system.')
     
@@ -227,6 +331,39 @@ class DatabaseBackend:
         """
         logger.critical(f'your database lib does not implement insert_on_conflict method')
     
+    def merge_rows(
+        self,
+        cursor,
+        df:pandas.DataFrame,
+        table:str,
+        conflict_key,
+        conflict_action=None)->int:
+        """
+        Upserts df with multi-row VALUES MERGEs, as many rows per
+        statement as max_bind_params (and max_merge_rows) allow. A MERGE
+        may not touch a target row twice, so duplicated keys are reduced
+        to the row a row by row merge would have left: the last one on
+        update, the first one otherwise. Returns the affected rows.
+        """
+        if conflict_key is None:
+            raise ValueError('conflict_key must be specified for a MERGE')
+        conflict_cols = list(conflict_key) if isinstance(conflict_key,(list,tuple)) else [conflict_key]
+        update = str(conflict_action).lower() == 'update'
+        df = df.drop_duplicates(conflict_cols,keep='last' if update else 'first')
+        rows = null_normalized_rows(df)
+        columns = list(df.columns)
+        batch_rows = max(min(self.max_bind_params // max(len(columns),1),self.max_merge_rows),1)
+        affected_rows = 0
+        statement = None
+        for start in range(0,len(rows),batch_rows):
+            batch = rows[start:start + batch_rows]
+            if statement is None or len(batch) != batch_rows:
+                statement = build_values_merge_sql(table,columns,conflict_cols,len(batch),update)
+            cursor.execute(statement,[value for row in batch for value in row])
+            affected_rows += max(cursor.rowcount,0)
+        self.logger.info(f'MERGE of {len(rows)} rows into {table} in {math.ceil(len(rows) / batch_rows)} statements')
+        return affected_rows
+
     def count_records(self,cursor,table):
         statement = f'SELECT COUNT(1) FROM {table};'
         #print(statement)
@@ -341,6 +478,81 @@ class DatabaseBackend:
             conn.close()
 
 
+def rows_to_record_batch(rows:list,columns:list)->pa.RecordBatch:
+    """
+    Builds a RecordBatch from DB-API rows. Columns whose values arrow
+    can not infer a single type for are kept as strings.
+    """
+    arrays = []
+    for values in zip(*rows):
+        try:
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid,pa.ArrowTypeError):
+            arrays.append(pa.array(
+                [None if value is None else str(value) for value in values],
+                type=pa.string()))
+    return pa.RecordBatch.from_arrays(arrays,names=columns)
+
+def null_normalized_rows(df:pandas.DataFrame)->list:
+    """Rows of df as tuples of python values, NaN/NaT/NA as None."""
+    values = df.astype(object)
+    values = values.where(values.notna(),None)
+    return list(values.itertuples(index=False,name=None))
+
+def build_values_merge_sql(
+        table:str,
+        columns:list,
+        conflict_cols:list,
+        rows:int,
+        update:bool=True)->str:
+    """
+    MERGE of `rows` rows bound as a multi-row VALUES list (one ? per
+    value, row by row). Matched rows are updated when update is set.
+    """
+    cols = [str(col).upper() for col in columns]
+    keys = [str(col).upper() for col in conflict_cols]
+    row_markers = f"({', '.join('?' for _ in cols)})"
+    update_cols = [col for col in cols if col not in keys]
+    conflict_behavior = ''
+    if update and update_cols:
+        update_clause = ', '.join(f'{col}=src.{col}' for col in update_cols)
+        conflict_behavior = f'WHEN MATCHED THEN UPDATE SET {update_clause}'
+    return f"""MERGE INTO {table} AS tgt
+                    USING (VALUES {', '.join(row_markers for _ in range(rows))})
+                    AS src ({', '.join(cols)})
+                    ON {' AND '.join(f'tgt.{col}=src.{col}' for col in keys)}
+                    {conflict_behavior}
+                    WHEN NOT MATCHED THEN INSERT ({', '.join(cols)})
+                    VALUES ({', '.join('src.'+col for col in cols)});"""
+
+def resolve_chunk_size(chunk_size)->int:
+    """chunk_size is either a row count or a callable returning one."""
+    if callable(chunk_size):
+        chunk_size = chunk_size()
+    return max(int(chunk_size),1)
+
+def rebatch_record_batches(batches,chunk_size):
+    """
+    Regroups an iterable of RecordBatches into batches of chunk_size rows
+    (the last one may be smaller). chunk_size may be a callable.
+    """
+    pending = []
+    pending_rows = 0
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= resolve_chunk_size(chunk_size):
+            rows = resolve_chunk_size(chunk_size)
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0,rows).combine_chunks().to_batches()[0]
+            rest = table.slice(rows)
+            pending = rest.to_batches()
+            pending_rows = rest.num_rows
+    if pending_rows > 0:
+        yield pa.Table.from_batches(pending).combine_chunks().to_batches()[0]
+
 @event.listens_for(Engine, 'before_cursor_execute')
 def on_query_start(conn, cursor, statement, parameters, context, executemany):
     if hasattr(conn, '_query_stats'):
@@ -33,6 +33,9 @@ class IbmDB2Backend(conn_abstract.DatabaseBackend):
         self.database_module = pyodbc
         self.driver_signature = '{IBM i Access ODBC Driver 64-bit}'
         self.ssl_mode = False
+        # DB2 takes far more parameter markers per statement than MSSQL (2100)
+        self.max_bind_params = int(kwargs.get('max_bind_params',10000))
+        self.max_merge_rows = int(kwargs.get('max_merge_rows',5000))
     
     def bulk_insert(self, active_connection: Engine,
                     data: pd.DataFrame,
@@ -71,6 +74,8 @@ class IbmDB2Backend(conn_abstract.DatabaseBackend):
     def table_exists(self,table_name:str,schema:str):
         
         try:
+            if self.get_schema_cache().has_table(schema,table_name):
+                return True
             conn = self.engine.raw_connection()
             cursor = conn.cursor()
             query = f"SELECT TABNAME FROM SYSCAT.TABLES WHERE TABNAME = '{table_name}' AND TABSCHEMA = '{schema}'"
@@ -145,8 +150,6 @@ class IbmDB2Backend(conn_abstract.DatabaseBackend):
         --------
         None
         """
-        #df.fillna(value=0, inplace=True)
-        df = df.where((pd.notnull(df)), None)
         # Create the target table object
         if self.create_table:
             target_table = Table(
@@ -158,117 +161,30 @@ class IbmDB2Backend(conn_abstract.DatabaseBackend):
                 ibm_db_ssl=False
             )
 
-        # Determine the insert behavior based on the if_exists argument
-        if if_exists == 'fail':
-            insert_behavior = None
-        elif if_exists == 'replace':
-            insert_behavior = 'replace'
-        else:
-            insert_behavior = 'append'
-
-        # Determine the conflict handling behavior based on the conflict_action argument
-        if conflict_action == 'ignore':
-            conflict_behavior = ''
-        elif conflict_action == 'update':
-            if conflict_key is None:
-                raise ValueError("conflict_key must be specified when using 'update' conflict action")
-            conflict_cols = conflict_key if isinstance(conflict_key, (list, tuple)) else (conflict_key,)
-            update_cols = [col for col in df.columns if col not in conflict_cols]
-            update_clause = ', '.join([f"{col.upper()}=src.{col.upper()}" for col in update_cols])
-            conflict_behavior = f"WHEN MATCHED THEN UPDATE SET {update_clause}"
+        if conflict_action == 'update' and conflict_key is None:
+            raise ValueError("conflict_key must be specified when using 'update' conflict action")
 
-            key_cols = conflict_key
-            if isinstance(conflict_key,list):
-                key_cols = ', '.join([col for col in conflict_key])
-        else:
-            conflict_behavior = ''
-
-        inserted_rows = 0
-        updated_rows = 0
-        max_rows = 10000
-        num_rows = len(df)
-        chunk_size = max_rows
         if isinstance(active_connection,Engine):
             connection = active_connection.raw_connection()
         else:
             connection = active_connection
         cursor = connection.cursor()
         total_rows_table_before = self.count_records(cursor,f'{schema}.{table_name}')
-        #self.logger.info(f'ROWS IN TARGET: {total_rows_table_before}')
 
-        def convert_double_precision_to_float(df):
-            for col in df.columns:
-                if df[col].dtype == 'float64':  # skip columns that are already float64
-                    continue
-                if df[col].dtype == 'object' and 'double precision' in str(df[col].dtype).lower():  # check if column is DOUBLE_PRECISION
-                    df[col] = df[col].apply(lambda x: float(x))
-            return df
-        
-        def extract_values(values):
-            t = []
-            #print('VALUES',values)
-            for x in values:
-                #print(x)
-                if x is None or pd.isna(x):
-                    #print('setting null')
-                    x = None
-                xx = x
-                t.append(xx)
-            return tuple(t)
-
-        max_bind_params = 500
-        chunk_size = min(max_rows, max_bind_params // len(df.columns))
+        affected_rows = self.merge_rows(
+            cursor,
+            df,
+            f'{schema}.{table_name}',
+            conflict_key,
+            conflict_action)
 
-        if len(df) > max_rows:
-            for i in range(0, num_rows, chunk_size):
-                df = df.where((pd.notnull(df)), None)
-                chunk = df.iloc[i:i+chunk_size]
-                rows_to_insert = [dict(row) for _, row in chunk.iterrows()]
-                
-                # Generate the SQL statement and execute it
-                merge_statement = f"""MERGE INTO {schema}.{table_name} AS tgt
-                    USING (VALUES ({', '.join([f'?' for col in df.columns])}))
-                    AS src ({', '.join([str(col).upper() for col in df.columns])})
-                    ON {' AND '.join([f'tgt.{col.upper()}=src.{col.upper()}' for col in conflict_cols])}
-                    {conflict_behavior}
-                    WHEN NOT MATCHED THEN INSERT ({', '.join([str(col).upper() for col in df.columns])})
-                    VALUES ({', '.join(['src.'+col.upper() for col in df.columns])});"""
-                records = [extract_values(x) for x in chunk.values] # [tuple(x) for x in chunk.values]
-                cursor.executemany(merge_statement, records)
-                inserted_rows += cursor.rowcount
-        else:
-            df = df.where((pd.notnull(df)), None)
-            rows_to_insert = [dict(row) for _, row in df.iterrows()]
-
-            merge_statement = f"""MERGE INTO {schema}.{table_name} AS tgt
-                    USING (VALUES ({', '.join([f'?' for col in df.columns])}))
-                    AS src ({', '.join([str(col).upper() for col in df.columns])})
-                    ON {' AND '.join([f'tgt.{col.upper()}=src.{col.upper()}' for col in conflict_cols])}
-                    {conflict_behavior}
-                    WHEN NOT MATCHED THEN INSERT ({', '.join([str(col).upper() for col in df.columns])})
-                    VALUES ({', '.join(['src.'+col.upper() for col in df.columns])});"""
-            
-            records = [extract_values(x) for x in df.values]
-            
-            # new_params = []
-            # for record in df.to_dict("records"):
-            #     params = {}
-            #     for key,value in record.items():
-            #         params[f":{key}"] = value
-            #     new_params.append(params)    
-            cursor.executemany(merge_statement, records)
-            #cursor.executemany(merge_statement, df.to_dict("records"))
-            inserted_rows = cursor.rowcount
-            
         cursor.execute('COMMIT;')
         total_rows_table_after = self.count_records(cursor,f'{schema}.{table_name}')
         cursor.close()
         connection.close()
-        inserted_rows_temp =  total_rows_table_after - total_rows_table_before
-        self.execution_metrics['inserted_rows'] += inserted_rows_temp
-        if inserted_rows_temp == 0:
-            updated_rows = inserted_rows
-        self.execution_metrics['updated_rows'] += updated_rows
+        inserted_rows = total_rows_table_after - total_rows_table_before
+        self.execution_metrics['inserted_rows'] += inserted_rows
+        self.execution_metrics['updated_rows'] += max(affected_rows - inserted_rows,0)
     
     # def insert_on_conflict(
     #     self, 
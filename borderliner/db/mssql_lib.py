@@ -11,11 +11,96 @@ from sqlalchemy.sql import text
 from psycopg2 import Timestamp
 from sqlalchemy import MetaData
 import pyodbc
+import re
 from sqlalchemy import create_engine, exc, text
 from sqlalchemy.engine import Engine
 import logging
 logging.basicConfig()
 
+# sql type name -> pyodbc type; sized types take their length/precision
+_ODBC_TYPES = {
+    'NVARCHAR':pyodbc.SQL_WVARCHAR,
+    'NCHAR':pyodbc.SQL_WCHAR,
+    'NTEXT':pyodbc.SQL_WLONGVARCHAR,
+    'VARCHAR':pyodbc.SQL_VARCHAR,
+    'CHAR':pyodbc.SQL_CHAR,
+    'TEXT':pyodbc.SQL_LONGVARCHAR,
+    'BIGINT':pyodbc.SQL_BIGINT,
+    'INT':pyodbc.SQL_INTEGER,
+    'INTEGER':pyodbc.SQL_INTEGER,
+    'SMALLINT':pyodbc.SQL_SMALLINT,
+    'TINYINT':pyodbc.SQL_TINYINT,
+    'BIT':pyodbc.SQL_BIT,
+    'DECIMAL':pyodbc.SQL_DECIMAL,
+    'NUMERIC':pyodbc.SQL_NUMERIC,
+    'MONEY':pyodbc.SQL_DECIMAL,
+    'FLOAT':pyodbc.SQL_DOUBLE,
+    'REAL':pyodbc.SQL_REAL,
+    'DATE':pyodbc.SQL_TYPE_DATE,
+    'DATETIME':pyodbc.SQL_TYPE_TIMESTAMP,
+    'DATETIME2':pyodbc.SQL_TYPE_TIMESTAMP,
+    'SMALLDATETIME':pyodbc.SQL_TYPE_TIMESTAMP,
+    'UNIQUEIDENTIFIER':pyodbc.SQL_GUID,
+}
+
+def odbc_input_size(sql_type:str):
+    """
+    setinputsizes entry (type, size, decimal digits) of a reflected
+    column type such as NVARCHAR(50), NVARCHAR(max) or DECIMAL(18, 2).
+    None lets the driver pick.
+    """
+    match = re.match(r'\s*(\w+)\s*(?:\(\s*(\w+)\s*(?:,\s*(\d+))?\s*\))?',str(sql_type))
+    if not match or match.group(1).upper() not in _ODBC_TYPES:
+        return None
+    name,size,digits = match.group(1).upper(),match.group(2),match.group(3)
+    odbc_type = _ODBC_TYPES[name]
+    if name in ('DECIMAL','NUMERIC'):
+        return (odbc_type,int(size or 18),int(digits or 0))
+    if name == 'MONEY':
+        return (odbc_type,19,4)
+    if name == 'DATE':
+        return (odbc_type,10,0)
+    if name in ('DATETIME2','DATETIME','SMALLDATETIME'):
+        # datetime2(7): 27 chars, 7 fractional digits
+        scale = 3 if name == 'DATETIME' else (0 if name == 'SMALLDATETIME' else int(size or 7))
+        return (odbc_type,20 + scale if scale else 19,scale)
+    if name in ('NVARCHAR','NCHAR','VARCHAR','CHAR'):
+        # (max) is bound with size 0
+        return (odbc_type,int(size) if size and size.isdigit() else 0,0)
+    return (odbc_type,0,0)
+
+def build_staged_merge_sql(
+        table:str,
+        staging:str,
+        columns:list,
+        conflict_cols:list,
+        update:bool=True)->str:
+    """
+    One MERGE of the staging table into table. The batch returns the
+    (inserted, updated) row counts from OUTPUT $action. It turns NOCOUNT
+    on for the session; the caller must turn it off again.
+    """
+    cols = [str(col).upper() for col in columns]
+    keys = [str(col).upper() for col in conflict_cols]
+    update_cols = [col for col in cols if col not in keys]
+    conflict_behavior = ''
+    if update and update_cols:
+        update_clause = ', '.join(f'tgt.{col}=src.{col}' for col in update_cols)
+        conflict_behavior = f'WHEN MATCHED THEN UPDATE SET {update_clause}'
+    return f"""SET NOCOUNT ON;
+        DECLARE @brdr_actions TABLE (merge_action NVARCHAR(10));
+        MERGE INTO {table} WITH (HOLDLOCK) AS tgt
+        USING {staging} AS src
+        ON {' AND '.join(f'tgt.{col}=src.{col}' for col in keys)}
+        {conflict_behavior}
+        WHEN NOT MATCHED THEN INSERT ({', '.join(cols)})
+        VALUES ({', '.join('src.'+col for col in cols)})
+        OUTPUT $action INTO @brdr_actions;
+        SELECT
+            COALESCE(SUM(CASE WHEN merge_action = 'INSERT' THEN 1 ELSE 0 END),0),
+            COALESCE(SUM(CASE WHEN merge_action = 'UPDATE' THEN 1 ELSE 0 END),0)
+        FROM @brdr_actions;"""
+
 class MsSqlBackend(conn_abstract.DatabaseBackend):
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
@@ -38,10 +123,15 @@ class MsSqlBackend(conn_abstract.DatabaseBackend):
         uri = f"{self.alchemy_engine_flag}://{self.user}:{self.password}@{self.host}/{self.database}?{self.driver_signature}"
         return uri 
     
-    def get_engine(self):
-        engine = create_engine(self.uri,ssl=self.ssl_mode,pool_pre_ping=True)
-        self.engine = engine
-        return engine
+    def get_engine(self,*args,**kwargs)->Engine:
+        """
+        Engine of the backend, built on first use and reused after that.
+        Passing create_engine kwargs (e.g. pool_size) builds a new one.
+        """
+        if isinstance(self.engine,Engine) and not kwargs:
+            return self.engine
+        self.engine = create_engine(self.uri,pool_pre_ping=True,**kwargs)
+        return self.engine
     
     
     
@@ -49,36 +139,104 @@ class MsSqlBackend(conn_abstract.DatabaseBackend):
                     data: pd.DataFrame,
                     schema: str,
                     table_name: str):
-        def extract_values(values):
-            t = []
-            #print('VALUES',values)
-            for x in values:
-                #print(x)
-                if x is None or pd.isna(x):
-                    #print('setting null')
-                    x = None
-                xx = x
-                t.append(xx)
-            return tuple(t)
-        
         table = f"{schema}.{table_name}"
         columns = ", ".join(data.columns)
-        values = [extract_values(x) for x in data.values]
+        values = conn_abstract.null_normalized_rows(data)
         stmt = f"INSERT INTO {table} ({columns}) VALUES ({', '.join([f'?' for col in data.columns])})"
         
-        conn = active_connection.raw_connection()
+        if isinstance(active_connection,Engine):
+            conn = active_connection.raw_connection()
+        else:
+            conn = active_connection
         cursor = conn.cursor()
         try:
+            self.prepare_fast_cursor(cursor,schema,table_name,data.columns)
             cursor.executemany(stmt, values)
             cursor.execute('COMMIT;')
-                   
-        except exc.SQLAlchemyError as e:
+            self.execution_metrics['processed_rows'] += len(data)
+            self.execution_metrics['inserted_rows'] += len(data)
+        except (exc.SQLAlchemyError,pyodbc.Error) as e:
             conn.rollback()
             raise e
         finally:
             cursor.close()     
-            conn.close()
+            if isinstance(active_connection,Engine):
+                conn.close()
     
+    def get_input_sizes(self,schema:str,table_name:str,columns:list)->list:
+        """setinputsizes entries of columns, from the cached table schema."""
+        table_columns = self.get_schema_cache().columns(schema,table_name)
+        return [
+            odbc_input_size(table_columns[str(col).lower()]) if str(col).lower() in table_columns else None
+            for col in columns
+        ]
+
+    def prepare_fast_cursor(self,cursor,schema:str,table_name:str,columns:list):
+        """
+        fast_executemany with parameter types bound up front, so pyodbc
+        does not fall back to per row binding (NVARCHAR(max) columns).
+        """
+        cursor.fast_executemany = True
+        input_sizes = self.get_input_sizes(schema,table_name,columns)
+        if any(size is not None for size in input_sizes):
+            cursor.setinputsizes(input_sizes)
+
+    def staged_merge(
+        self,
+        active_connection: Engine,
+        df: pd.DataFrame,
+        schema: str,
+        table_name: str,
+        conflict_key=None,
+        conflict_action='update'):
+        """
+        Copies df into a #temp table shaped like the target (SELECT TOP 0
+        ... INTO) with a typed fast_executemany, then applies it with one
+        MERGE. Keys repeated in df keep their last row on update, the
+        first one otherwise.
+        """
+        if conflict_key is None:
+            raise ValueError('conflict_key must be specified for STAGED_MERGE')
+        conflict_cols = list(conflict_key) if isinstance(conflict_key,(list,tuple)) else [conflict_key]
+        update = str(conflict_action).lower() == 'update'
+        df = df.drop_duplicates(conflict_cols,keep='last' if update else 'first')
+        table = f'{schema}.{table_name}'
+        staging = f'#brdr_stg_{table_name}'
+        columns = ', '.join(str(col) for col in df.columns)
+        if isinstance(active_connection,Engine):
+            connection = active_connection.raw_connection()
+        else:
+            connection = active_connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"IF OBJECT_ID('tempdb..{staging}') IS NOT NULL DROP TABLE {staging};")
+            cursor.execute(f'SELECT TOP 0 {columns} INTO {staging} FROM {table};')
+            self.prepare_fast_cursor(cursor,schema,table_name,df.columns)
+            cursor.executemany(
+                f"INSERT INTO {staging} ({columns}) VALUES ({', '.join('?' for _ in df.columns)})",
+                conn_abstract.null_normalized_rows(df))
+            self.execution_metrics['staged_rows'] = self.execution_metrics.get('staged_rows',0) + len(df)
+            cursor.execute(build_staged_merge_sql(table,staging,list(df.columns),conflict_cols,update))
+            inserted_rows,updated_rows = cursor.fetchone()
+            cursor.execute(f'DROP TABLE {staging};')
+            cursor.execute('COMMIT;')
+            self.logger.info(f'STAGED_MERGE into {table}: {inserted_rows} inserted, {updated_rows} updated')
+            self.execution_metrics['processed_rows'] += len(df)
+            self.execution_metrics['inserted_rows'] += int(inserted_rows)
+            self.execution_metrics['updated_rows'] += int(updated_rows)
+        except pyodbc.Error as e:
+            connection.rollback()
+            raise e
+        finally:
+            try:
+                # NOCOUNT outlives the batch on the pooled connection
+                cursor.execute('SET NOCOUNT OFF;')
+            except pyodbc.Error:
+                pass
+            cursor.close()
+            if isinstance(active_connection,Engine):
+                connection.close()
+
     def table_exists(self,table_name:str,schema:str):
         
         try:
@@ -120,12 +278,6 @@ class MsSqlBackend(conn_abstract.DatabaseBackend):
         kwargs['ssl'] = False
         return self.get_engine(*args, **kwargs)
     
-    def get_engine(self,*args,**kwargs)->Engine:
-        if isinstance(self.engine,Engine):
-            return self.engine
-        self.engine = create_engine(self.uri)
-        return self.engine
-    
     def insert_on_conflict(
         self, 
         active_connection: Engine, 
@@ -160,8 +312,6 @@ class MsSqlBackend(conn_abstract.DatabaseBackend):
         --------
         None
         """
-        #df.fillna(value=0, inplace=True)
-        df = df.where((pd.notnull(df)), None)
         # Create the target table object
         if self.create_table:
             target_table = Table(
@@ -173,119 +323,30 @@ class MsSqlBackend(conn_abstract.DatabaseBackend):
                 ssl=self.ssl_mode
             )
 
-        # Determine the insert behavior based on the if_exists argument
-        if if_exists == 'fail':
-            insert_behavior = None
-        elif if_exists == 'replace':
-            insert_behavior = 'replace'
-        else:
-            insert_behavior = 'append'
-
-        # Determine the conflict handling behavior based on the conflict_action argument
-        if conflict_action == 'ignore':
-            conflict_behavior = ''
-        elif conflict_action == 'update':
-            if conflict_key is None:
-                raise ValueError("conflict_key must be specified when using 'update' conflict action")
-            conflict_cols = conflict_key if isinstance(conflict_key, (list, tuple)) else (conflict_key,)
-            update_cols = [col for col in df.columns if col not in conflict_cols]
-            update_clause = ', '.join([f"{col.upper()}=src.{col.upper()}" for col in update_cols])
-            conflict_behavior = f"WHEN MATCHED THEN UPDATE SET {update_clause}"
-
-            key_cols = conflict_key
-            if isinstance(conflict_key,list):
-                key_cols = ', '.join([col for col in conflict_key])
-        else:
-            conflict_behavior = ''
+        if conflict_action == 'update' and conflict_key is None:
+            raise ValueError("conflict_key must be specified when using 'update' conflict action")
 
-        inserted_rows = 0
-        updated_rows = 0
-        max_rows = 10000
-        num_rows = len(df)
-        chunk_size = max_rows
         if isinstance(active_connection,Engine):
             connection = active_connection.raw_connection()
         else:
             connection = active_connection
         cursor = connection.cursor()
-        cursor.fast_executemany = True
         total_rows_table_before = self.count_records(cursor,f'{schema}.{table_name}')
-        #self.logger.info(f'ROWS IN TARGET: {total_rows_table_before}')
-
-        def convert_double_precision_to_float(df):
-            for col in df.columns:
-                if df[col].dtype == 'float64':  # skip columns that are already float64
-                    continue
-                if df[col].dtype == 'object' and 'double precision' in str(df[col].dtype).lower():  # check if column is DOUBLE_PRECISION
-                    df[col] = df[col].apply(lambda x: float(x))
-            return df
-        
-        def extract_values(values):
-            t = []
-            #print('VALUES',values)
-            for x in values:
-                #print(x)
-                if x is None or pd.isna(x):
-                    #print('setting null')
-                    x = None
-                xx = x
-                t.append(xx)
-            return tuple(t)
 
-        max_bind_params = 500
-        chunk_size = min(max_rows, max_bind_params // len(df.columns))
-
-        if len(df) > max_rows:
-            for i in range(0, num_rows, chunk_size):
-                df = df.where((pd.notnull(df)), None)
-                chunk = df.iloc[i:i+chunk_size]
-                rows_to_insert = [dict(row) for _, row in chunk.iterrows()]
-                
-                # Generate the SQL statement and execute it
-                merge_statement = f"""MERGE INTO {schema}.{table_name} AS tgt
-                    USING (VALUES ({', '.join([f'?' for col in df.columns])}))
-                    AS src ({', '.join([str(col).upper() for col in df.columns])})
-                    ON {' AND '.join([f'tgt.{col.upper()}=src.{col.upper()}' for col in conflict_cols])}
-                    {conflict_behavior}
-                    WHEN NOT MATCHED THEN INSERT ({', '.join([str(col).upper() for col in df.columns])})
-                    VALUES ({', '.join(['src.'+col.upper() for col in df.columns])});"""
-                records = [extract_values(x) for x in chunk.values] # [tuple(x) for x in chunk.values]
-                cursor.executemany(merge_statement, records)
-                inserted_rows += cursor.rowcount
-        else:
-            df = df.where((pd.notnull(df)), None)
-            rows_to_insert = [dict(row) for _, row in df.iterrows()]
+        affected_rows = self.merge_rows(
+            cursor,
+            df,
+            f'{schema}.{table_name}',
+            conflict_key,
+            conflict_action)
 
-            merge_statement = f"""MERGE INTO {schema}.{table_name} AS tgt
-                    USING (VALUES ({', '.join([f'?' for col in df.columns])}))
-                    AS src ({', '.join([str(col).upper() for col in df.columns])})
-                    ON {' AND '.join([f'tgt.{col.upper()}=src.{col.upper()}' for col in conflict_cols])}
-                    {conflict_behavior}
-                    WHEN NOT MATCHED THEN INSERT ({', '.join([str(col).upper() for col in df.columns])})
-                    VALUES ({', '.join(['src.'+col.upper() for col in df.columns])});"""
-            
-            records = [extract_values(x) for x in df.values]
-            
-            # new_params = []
-            # for record in df.to_dict("records"):
-            #     params = {}
-            #     for key,value in record.items():
-            #         params[f":{key}"] = value
-            #     new_params.append(params)    
-            
-            cursor.executemany(merge_statement, records)
-            #cursor.executemany(merge_statement, df.to_dict("records"))
-            inserted_rows = cursor.rowcount
-            
         cursor.execute('COMMIT;')
         total_rows_table_after = self.count_records(cursor,f'{schema}.{table_name}')
         cursor.close()
         connection.close()
-        inserted_rows_temp =  total_rows_table_after - total_rows_table_before
-        self.execution_metrics['inserted_rows'] += inserted_rows_temp
-        if inserted_rows_temp == 0:
-            updated_rows = inserted_rows
-        self.execution_metrics['updated_rows'] += updated_rows
+        inserted_rows = total_rows_table_after - total_rows_table_before
+        self.execution_metrics['inserted_rows'] += inserted_rows
+        self.execution_metrics['updated_rows'] += max(affected_rows - inserted_rows,0)
     
     
 
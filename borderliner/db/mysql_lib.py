@@ -5,7 +5,6 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
 import warnings
 import pandas as pd
-from sqlalchemy import Table
 from sqlalchemy.sql import text
 from psycopg2 import Timestamp
 from sqlalchemy import MetaData
@@ -15,12 +14,59 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
 import warnings
 import pandas as pd
-from sqlalchemy import Table
 from sqlalchemy.sql import text
 from sqlalchemy import MetaData
 from sqlalchemy import create_engine, exc, text
 from sqlalchemy.engine import Engine
 import MySQLdb
+import os
+import tempfile
+import uuid
+
+def build_upsert_sql(table:str,columns:list,source:str,update_columns:list=None)->str:
+    """
+    INSERT of source (a VALUES list or a SELECT) into table. Duplicated
+    keys get update_columns updated, or are ignored without them.
+    """
+    column_str = ', '.join(columns)
+    if not update_columns:
+        return f"""INSERT IGNORE INTO {table} ({column_str}) 
+                    {source};"""
+    update_clause = ', '.join([f"{col}=VALUES({col})" for col in update_columns])
+    return f"""INSERT INTO {table} ({column_str}) 
+                    {source} 
+                    ON DUPLICATE KEY UPDATE {update_clause};"""
+
+def build_load_data_sql(filename:str,table:str,columns:list)->str:
+    """LOAD DATA LOCAL INFILE of a file written by write_infile_csv."""
+    return f"""LOAD DATA LOCAL INFILE '{filename}' INTO TABLE {table}
+                CHARACTER SET utf8mb4
+                FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+                LINES TERMINATED BY '\\n'
+                ({', '.join(columns)});"""
+
+def write_infile_csv(df:pd.DataFrame,filename:str):
+    """
+    Writes df for LOAD DATA: every value enclosed in double quotes, nulls
+    as the bare word NULL (read as NULL, unlike a quoted "NULL"), booleans
+    as 1/0. There is no escape character, quotes are doubled.
+    """
+    fields = []
+    for col in df.columns:
+        series = df[col]
+        if series.dtype == bool:
+            series = series.astype(int)
+        text_values = '"' + series.astype(str).str.replace('"','""',regex=False) + '"'
+        fields.append(text_values.where(series.notna(),'NULL'))
+    if not fields:
+        return
+    lines = fields[0]
+    for field in fields[1:]:
+        lines = lines + ',' + field
+    with open(filename,'w',encoding='utf-8',newline='') as f:
+        for line in lines:
+            f.write(line)
+            f.write('\n')
 
 
 class MySqlBackend(conn_abstract.DatabaseBackend):
@@ -38,6 +84,13 @@ class MySqlBackend(conn_abstract.DatabaseBackend):
         self.database_module = MySQLdb
         self.driver_signature = ''
         self.ssl_mode = False
+        # upserts of at least load_data_min_rows rows go through LOAD DATA LOCAL INFILE
+        # (the server needs local_infile=ON), smaller ones through multi-row VALUES
+        self.load_data_infile = bool(kwargs.get('load_data_infile',False))
+        self.load_data_min_rows = int(kwargs.get('load_data_min_rows',5000))
+        self.max_bind_params = int(kwargs.get('max_bind_params',60000))
+        self.use_count_for_metrics = bool(kwargs.get('use_count_for_metrics',False))
+        self.execution_metrics['staged_rows'] = 0
 
     def table_exists(self, table_name: str, schema: str):
         try:
@@ -72,7 +125,10 @@ class MySqlBackend(conn_abstract.DatabaseBackend):
     def get_engine(self, *args, **kwargs) -> Engine:
         if isinstance(self.engine, Engine):
             return self.engine
-        self.engine = create_engine(self.uri)
+        if self.load_data_infile:
+            self.engine = create_engine(self.uri,connect_args={'allow_local_infile':True})
+        else:
+            self.engine = create_engine(self.uri)
         return self.engine
     
     def bulk_insert(self, active_connection: Engine,
@@ -99,6 +155,52 @@ class MySqlBackend(conn_abstract.DatabaseBackend):
         finally:
             conn.close()
 
+    def upsert_values(self,cursor,df:pd.DataFrame,table:str,update_columns:list=None)->int:
+        """Upserts df with multi-row VALUES statements, returns the affected rows."""
+        rows = conn_abstract.null_normalized_rows(df)
+        columns = [str(col) for col in df.columns]
+        row_str = f"({', '.join(['%s' for _ in columns])})"
+        batch_rows = max(min(self.max_bind_params // max(len(columns),1),self.max_merge_rows),1)
+        affected_rows = 0
+        for start in range(0,len(rows),batch_rows):
+            batch = rows[start:start + batch_rows]
+            statement = build_upsert_sql(
+                table,
+                columns,
+                'VALUES ' + ', '.join([row_str for _ in batch]),
+                update_columns)
+            cursor.execute(statement,[value for row in batch for value in row])
+            affected_rows += max(cursor.rowcount,0)
+        return affected_rows
+
+    def upsert_load_data(self,cursor,df:pd.DataFrame,table_name:str,update_columns:list=None)->int:
+        """
+        Streams df as a CSV file through LOAD DATA LOCAL INFILE into a
+        session temporary table, then upserts it with a single
+        INSERT ... SELECT. Returns the affected rows.
+        """
+        columns = [str(col) for col in df.columns]
+        staging = f'brdr_stg_{uuid.uuid4().hex[:12]}'
+        fd,filename = tempfile.mkstemp(prefix='brdr_mysql_',suffix='.csv')
+        os.close(fd)
+        try:
+            write_infile_csv(df,filename)
+            # no indexes on the staging table: keys are checked by the upsert
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {staging} SELECT {', '.join(columns)} FROM {table_name} LIMIT 0;")
+            cursor.execute(build_load_data_sql(filename.replace('\\','/'),staging,columns))
+            self.execution_metrics['staged_rows'] += len(df)
+            cursor.execute(build_upsert_sql(
+                table_name,
+                columns,
+                f"SELECT {', '.join(columns)} FROM {staging}",
+                update_columns))
+            affected_rows = max(cursor.rowcount,0)
+            cursor.execute(f'DROP TEMPORARY TABLE {staging};')
+            return affected_rows
+        finally:
+            os.remove(filename)
+
     def insert_on_conflict(self, 
             active_connection: Engine, 
             df: pd.DataFrame, 
@@ -107,80 +209,53 @@ class MySqlBackend(conn_abstract.DatabaseBackend):
             if_exists='append', 
             conflict_key=None, 
             conflict_action=None):
-        # Create the target table object
-        target_table = Table(
-            table_name,
-            self.meta,
-            autoload=True,
-            autoload_with=active_connection
-        )
-
-        # Determine the insert behavior based on the if_exists argument
-        if if_exists == 'fail':
-            insert_behavior = None
-        elif if_exists == 'replace':
-            insert_behavior = 'replace'
-        else:
-            insert_behavior = 'append'
+        """
+        Upserts df into table_name: LOAD DATA LOCAL INFILE into a staging
+        table plus one INSERT ... SELECT ... ON DUPLICATE KEY UPDATE for
+        large chunks (load_data_infile), multi-row VALUES otherwise.
+        conflict_action update updates duplicated keys, anything else
+        ignores them.
+        """
+        update = str(conflict_action).lower() == 'update'
+        if update and conflict_key is None:
+            raise ValueError("conflict_key must be specified when using 'update' conflict action")
+        update_columns = None
+        if conflict_key is not None:
+            conflict_cols = conflict_key if isinstance(conflict_key, (list, tuple)) else [conflict_key]
+            # the last row of a key wins, as with row by row upserts
+            df = df.drop_duplicates(list(conflict_cols),keep='last' if update else 'first')
+            if update:
+                update_columns = [str(col) for col in df.columns if col not in conflict_cols]
 
-        # Determine the conflict handling behavior based on the conflict_action argument
-        if conflict_action == 'ignore':
-            conflict_behavior = ''
-        elif conflict_action == 'update':
-            if conflict_key is None:
-                raise ValueError("conflict_key must be specified when using 'update' conflict action")
-            conflict_cols = conflict_key if isinstance(conflict_key, (list, tuple)) else (conflict_key,)
-            update_cols = [col for col in df.columns if col not in conflict_cols]
-            update_clause = ', '.join([f"{col}=VALUES({col})" for col in update_cols])
-            conflict_behavior = f"ON DUPLICATE KEY UPDATE {update_clause}"
-            key_cols = conflict_key
-            if isinstance(conflict_key,list):
-                key_cols = ', '.join([col for col in conflict_key])
-        else:
-            conflict_behavior = ''
-
-        inserted_rows = 0
-        updated_rows = 0
-        max_rows = 1000
-        num_rows = len(df)
-        chunk_size = max_rows
         if isinstance(active_connection,Engine):
             connection = active_connection.raw_connection()
         else:
             connection = active_connection
         cursor = connection.cursor()
-        total_rows_table_before = self.count_records(cursor,f'{table_name}')
-        self.logger.info(f'ROWS IN TARGET: {total_rows_table_before}')
-        if len(df) > max_rows:
-            for i in range(0, num_rows, chunk_size):
-                chunk = df.iloc[i:i+chunk_size]
-                # Generate the SQL statement and execute it
-                values_str = ', '.join(['%s' for x in chunk.columns])
-                column_str = ', '.join(chunk.columns)
-                values = [self.extract_values(x) for x in chunk.values]
-                merge_statement = f"""INSERT INTO {table_name} ({column_str}) 
-                            VALUES ({values_str}) 
-                            ON DUPLICATE KEY UPDATE {update_clause};"""
-                cursor.executemany(merge_statement,values)
-                inserted_rows += cursor.rowcount
-                #updated_rows += len(chunk)-cursor.rowcount
-        else:
-            values_str = ', '.join(['%s' for x in df.columns])
-            column_str = ', '.join(df.columns)
-            values = [self.extract_values(x) for x in df.values]
-            merge_statement = f"""INSERT INTO {table_name} ({column_str}) 
-                        VALUES ({values_str}) 
-                        ON DUPLICATE KEY UPDATE {update_clause};"""
-            cursor.executemany(merge_statement, values)
-            inserted_rows = cursor.rowcount
-        cursor.execute('COMMIT;')
-        total_rows_table_after = self.count_records(cursor,f'{table_name}')
-        cursor.close()
-        connection.close()
-        inserted_rows_temp = total_rows_table_before - total_rows_table_after
-        self.execution_metrics['inserted_rows'] += inserted_rows_temp
-        if inserted_rows_temp == 0:
-            updated_rows = inserted_rows
-        self.execution_metrics['updated_rows'] += updated_rows
+        try:
+            self.execution_metrics['processed_rows'] += len(df)
+            if self.use_count_for_metrics:
+                total_rows_table_before = self.count_records(cursor,f'{table_name}')
+            if self.load_data_infile and len(df) >= self.load_data_min_rows:
+                affected_rows = self.upsert_load_data(cursor,df,table_name,update_columns)
+            else:
+                affected_rows = self.upsert_values(cursor,df,table_name,update_columns)
+            cursor.execute('COMMIT;')
+            if self.use_count_for_metrics:
+                total_rows_table_after = self.count_records(cursor,f'{table_name}')
+                inserted_rows = total_rows_table_after - total_rows_table_before
+                updated_rows = len(df) - inserted_rows
+            else:
+                # affected rows: 1 per insert, 2 per changed duplicate, 0 per unchanged one
+                updated_rows = min(max(affected_rows - len(df),0),len(df))
+                inserted_rows = max(affected_rows - 2 * updated_rows,0)
+            self.execution_metrics['inserted_rows'] += inserted_rows
+            self.execution_metrics['updated_rows'] += updated_rows
+        except Exception as e:
+            connection.rollback()
+            raise e
+        finally:
+            cursor.close()
+            connection.close()
 
 Connection = MySqlBackend
\ No newline at end of file
@@ -43,6 +43,8 @@ class OracleBackend(conn_abstract.DatabaseBackend):
     
     def table_exists(self, table_name: str, schema: str):
         try:
+            if self.get_schema_cache().has_table(schema,table_name):
+                return True
             conn = self.engine.raw_connection()
             cur = conn.cursor()
             query = f"SELECT table_name FROM all_tables WHERE table_name = '{table_name}' AND owner = '{schema.upper()}'"
@@ -60,10 +62,14 @@ class OracleBackend(conn_abstract.DatabaseBackend):
         table_name, 
         column_name, 
         dtype, 
-        if_not_exists='append'):
+        if_not_exists='append',
+        schema=None):
         """
         Check if column exists on db.
         """
+        schema_cache = self.get_schema_cache()
+        if schema_cache.has_column(schema,table_name,column_name):
+            return 0
         q = f"SELECT count(*) FROM all_tab_cols " \
             f"where table_name = '{table_name.upper()}' and column_name = '{column_name.upper()}'"
         conn = active_connection
@@ -74,6 +80,7 @@ class OracleBackend(conn_abstract.DatabaseBackend):
                 dt = OracleBackend._sql_type_name(dtype.__str__())
                 qc = f"ALTER TABLE {table_name} ADD {column_name.upper()} {dt}"
                 conn.execute(qc)
+                schema_cache.invalidate(schema,table_name)
                 return 0
             else:
                 print(conn.execute(q).fetchone())
@@ -105,7 +112,8 @@ class OracleBackend(conn_abstract.DatabaseBackend):
                         active_connection,
                         table_name, 
                         column, 
-                        infer_dtype(df[column]))
+                        infer_dtype(df[column]),
+                        schema=schema)
                 
                 col_names = ','.join(str(e) for e in df.columns)
                 data = [tuple(x) for x in df.values]
@@ -1,7 +1,5 @@
-import math
 from . import conn_abstract
 from pandas._libs.lib import infer_dtype
-from psycopg2.extras import execute_values
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
 import warnings
@@ -10,6 +8,66 @@ from sqlalchemy.sql import text
 from psycopg2 import Timestamp
 from sqlalchemy.dialects.postgresql import insert
 import psycopg2
+import uuid
+import os
+import threading
+import csv
+import io
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from pandas.api import types as ptypes
+from urllib.parse import quote_plus
+# postgres type oid -> arrow type for COPY extraction, anything else is text
+PG_ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us',tz='UTC'),
+}
+
+def copy_csv_payload(data:pandas.DataFrame|pa.Table,keep_nan:bool=False)->tuple:
+    """
+    Encodes data as COPY csv and returns (file-like, null marker).
+
+    Arrow writes strings quoted and nulls as unquoted empty fields, so
+    NULL '' keeps empty strings apart from nulls. Frames arrow can not
+    convert (mixed object columns) go through pandas, with nulls as \\N.
+    NaN in float columns is written as NULL, or as NaN with keep_nan.
+    """
+    nan_columns = []
+    if keep_nan and isinstance(data,pandas.DataFrame):
+        nan_columns = [col for col in data.columns if ptypes.is_float_dtype(data[col].dtype)]
+    try:
+        table = data if isinstance(data,pa.Table) else pa.Table.from_pandas(data,preserve_index=False)
+        columns = [
+            column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+            for column in table.columns
+        ]
+        for col in nan_columns:
+            # from_pandas turned NaN into null
+            columns[table.column_names.index(str(col))] = pa.array(data[col].to_numpy(),from_pandas=False)
+        table = pa.Table.from_arrays(columns,names=table.column_names)
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(table,sink,pa_csv.WriteOptions(include_header=False))
+        return pa.BufferReader(sink.getvalue()),''
+    except (pa.ArrowInvalid,pa.ArrowTypeError,pa.ArrowNotImplementedError):
+        if isinstance(data,pa.Table):
+            data = data.to_pandas()
+        if nan_columns:
+            data = data.assign(**{
+                str(col):data[col].astype(object).where(data[col].notna(),'NaN')
+                for col in nan_columns
+            })
+        buffer = io.StringIO()
+        data.to_csv(buffer,index=False,header=False,na_rep='\\N',quoting=csv.QUOTE_MINIMAL)
+        buffer.seek(0)
+        return buffer,'\\N'
+
 class PostgresBackend(conn_abstract.DatabaseBackend):
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
@@ -55,6 +113,8 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
     
     def table_exists(self,table_name:str,schema:str):
         try:
+            if self.get_schema_cache().has_table(schema,table_name):
+                return True
             conn = self.engine.raw_connection()
             cur = conn.cursor()
             query = f"SELECT table_name FROM information_schema.tables WHERE table_name = '{table_name}' AND table_schema = '{schema}'"
@@ -70,6 +130,211 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
 
 
 
+    def get_streaming_cursor(self,connection,fetch_size:int=10000):
+        """
+        Named (server-side) cursor, so psycopg2 fetches the result set
+        in blocks of fetch_size rows instead of loading it all at once.
+        """
+        cursor = connection.cursor(name=f'brdr_{uuid.uuid4().hex}')
+        cursor.itersize = fetch_size
+        return cursor
+
+    def stream_record_batches(self,query,chunk_size:int=100000,fetch_size:int=None):
+        """
+        Uses the ADBC postgres driver when it is installed, which hands
+        back arrow data directly; otherwise falls back to the cursor.
+        """
+        try:
+            import adbc_driver_postgresql.dbapi as adbc
+        except ImportError:
+            yield from super().stream_record_batches(query,chunk_size,fetch_size)
+            return
+        uri = f'postgresql://{quote_plus(str(self.user))}:{quote_plus(str(self.password))}' \
+            f'@{self.host}:{self.port}/{self.database}'
+        with adbc.connect(uri) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(str(query))
+                yield from conn_abstract.rebatch_record_batches(
+                    cursor.fetch_record_batch(),
+                    chunk_size)
+
+    @staticmethod
+    def _arrow_type(column)->pa.DataType:
+        """
+        Arrow type used to parse COPY csv output for a cursor column.
+        NUMERIC without precision (or above decimal128's 38 digits) stays
+        text instead of losing digits as float64.
+        """
+        if column.type_code == 1700:
+            if column.precision and column.precision <= 38:
+                return pa.decimal128(column.precision,column.scale or 0)
+            return pa.string()
+        return PG_ARROW_TYPES.get(column.type_code,pa.string())
+
+    def copy_query_batches(self,query,chunk_size:int=100000):
+        """
+        Extracts query with COPY (...) TO STDOUT (FORMAT csv) and parses
+        the stream with the pyarrow csv reader, yielding RecordBatches of
+        chunk_size rows. Column types come from the query description, so
+        nothing is inferred from the data.
+        """
+        query = str(query).strip().rstrip(';')
+        connection = self.get_raw_connection()
+        cursor = connection.cursor()
+        read_fd,write_fd = os.pipe()
+        reader_file = os.fdopen(read_fd,'rb')
+        writer_file = os.fdopen(write_fd,'wb')
+        copy_errors = []
+        def _copy():
+            try:
+                cursor.copy_expert(
+                    f'COPY ({query}) TO STDOUT WITH (FORMAT csv)',
+                    writer_file)
+            except BaseException as e:
+                copy_errors.append(e)
+            finally:
+                try:
+                    writer_file.close()
+                except OSError:
+                    pass
+
+        copy_thread = None
+        reader = None
+        try:
+            cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+            cursor.execute("SET LOCAL DateStyle TO 'ISO, YMD'")
+            cursor.execute(f'SELECT * FROM ({query}) brdr_copy LIMIT 0')
+            names = [column.name for column in cursor.description]
+            types = {
+                column.name:self._arrow_type(column)
+                for column in cursor.description
+            }
+            copy_thread = threading.Thread(target=_copy,daemon=True)
+            copy_thread.start()
+            reader = pa_csv.open_csv(
+                reader_file,
+                read_options=pa_csv.ReadOptions(column_names=names),
+                parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types=types,
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                    null_values=[''],
+                    true_values=['t'],
+                    false_values=['f']))
+            yield from conn_abstract.rebatch_record_batches(reader,chunk_size)
+        except Exception:
+            if copy_errors:
+                raise copy_errors[0]
+            raise
+        finally:
+            if reader is not None:
+                reader.close()
+            reader_file.close()
+            if copy_thread is not None:
+                copy_thread.join()
+            else:
+                writer_file.close()
+            cursor.close()
+            connection.rollback()
+            connection.close()
+        if copy_errors:
+            raise copy_errors[0]
+
+    def copy_into(self,cursor,df:pandas.DataFrame|pa.Table,table:str)->int:
+        """
+        Streams df into table with COPY ... FROM STDIN (csv) on cursor.
+        Does not commit. Returns the number of rows sent. Float NaN is
+        loaded as NaN unless the backend option replace_nan is set, which
+        loads it as NULL.
+        """
+        columns = df.column_names if isinstance(df,pa.Table) else list(df.columns)
+        payload,null = copy_csv_payload(df,keep_nan=not self.kwargs.get('replace_nan',False))
+        col_names = ','.join(str(e) for e in columns)
+        cursor.copy_expert(
+            f"COPY {table} ({col_names}) FROM STDIN WITH (FORMAT csv, NULL '{null}')",
+            payload)
+        return len(df)
+
+    def copy_insert(self,active_connection,df:pandas.DataFrame,schema:str,table_name:str):
+        """
+        Loads df with COPY in one transaction (insertion_method: COPY).
+        active_connection may be an engine or a raw connection.
+        """
+        if isinstance(active_connection,Engine):
+            connection = active_connection.raw_connection()
+            close_connection = True
+        else:
+            connection = active_connection
+            close_connection = False
+        table = f'{schema}.{table_name}' if schema else table_name
+        cursor = connection.cursor()
+        try:
+            self.logger.info(f'COPY {len(df)} rows into {table}')
+            rows = self.copy_into(cursor,df,table)
+            connection.commit()
+            self.execution_metrics['processed_rows'] += rows
+            self.execution_metrics['inserted_rows'] += rows
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            if close_connection:
+                connection.close()
+
+    def upsert_from_temp_table(
+            self,
+            cursor,
+            df:pandas.DataFrame,
+            table:str,
+            conflict_key:list,
+            update:bool=True)->int:
+        """
+        Set based upsert: COPY df into a session temp table holding only
+        df's columns, typed as in table and without its constraints (so
+        identity/serial keys missing from df do not fail), then one
+        INSERT ... SELECT ... ON CONFLICT (or MERGE, with backend option
+        use_merge on postgres 15+). Runs in the caller's
+        transaction, the temp table is dropped on commit.
+        Returns the rows inserted or updated.
+        """
+        temp_table = f'brdr_tmp_{uuid.uuid4().hex[:16]}'
+        columns = [str(e) for e in df.columns]
+        col_names = ','.join(columns)
+        cursor.execute(
+            f'CREATE TEMP TABLE {temp_table} ON COMMIT DROP AS SELECT {col_names} FROM {table} WITH NO DATA')
+        self.copy_into(cursor,df,temp_table)
+        update_columns = [col for col in columns if col not in conflict_key]
+        if self.kwargs.get('use_merge',False) and cursor.connection.server_version >= 150000:
+            on_clause = ' AND '.join(f'tgt.{key} = src.{key}' for key in conflict_key)
+            insert_values = ','.join(f'src.{col}' for col in columns)
+            merge_sql = f"""
+                MERGE INTO {table} tgt
+                USING {temp_table} src ON ({on_clause})
+                """
+            if update and update_columns:
+                update_set = ','.join(f'{col} = src.{col}' for col in update_columns)
+                merge_sql += f"WHEN MATCHED THEN UPDATE SET {update_set}\n"
+            merge_sql += f"WHEN NOT MATCHED THEN INSERT ({col_names}) VALUES ({insert_values})"
+            cursor.execute(merge_sql)
+            return cursor.rowcount
+        if update and update_columns:
+            update_set = ','.join(f'{col} = EXCLUDED.{col}' for col in update_columns)
+            conflict_sql = f'DO UPDATE SET {update_set}'
+        else:
+            conflict_sql = 'DO NOTHING'
+        cursor.execute(f"""
+            INSERT INTO {table} ({col_names})
+                SELECT {col_names} FROM {temp_table}
+            ON CONFLICT ({','.join(conflict_key)}) {conflict_sql}
+            """)
+        return cursor.rowcount
+
+    def bulk_insert(self,active_connection,df:pandas.DataFrame,schema:str,table_name:str):
+        """BULK_INSERT/FULL_COPY through COPY instead of row inserts."""
+        return self.copy_insert(active_connection,df,schema,table_name)
+
     #@staticmethod
     def column_exists_db(
         self,
@@ -77,13 +342,17 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
         table_name, 
         column_name, 
         dtype, 
-        if_not_exists='append'):
+        if_not_exists='append',
+        schema=None):
         """
         Check if colunm exists on db.
 
         @TODO: This only works with postgres databases. Need a method 
         for all attended databases types.
         """
+        schema_cache = self.get_schema_cache()
+        if schema_cache.has_column(schema,table_name,column_name):
+            return 0
         q = f"SELECT count(*) FROM information_schema.columns " \
             f"where table_name = '{table_name}' and column_name = '{column_name}'"
         conn = active_connection
@@ -94,6 +363,7 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                 dt = PostgresBackend._sql_type_name(dtype.__str__())
                 qc = f"ALTER TABLE {table_name} ADD COLUMN {column_name.lower()} {dt}"
                 conn.execute(qc)
+                schema_cache.invalidate(schema,table_name)
                 #active_connection.commit()
                 #self.logger.log(self.logger.CRITICAL, ("%s column didn't existed in the %s. Added." % (column_name, table_name)))
                 return 0
@@ -148,69 +418,29 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                         self.engine,
                         table_name, 
                         column, 
-                        infer_dtype(df[column]))
+                        infer_dtype(df[column]),
+                        schema=schema)
                 
                 df.rename({'user':'"user"'},axis=1,inplace=True)
-                col_names = ','.join(str(e) for e in df.columns)
-                data = [tuple(x) for x in df.values]
-
-                # Replace NaN's with None
-                if self.kwargs.get('replace_nan',False):
-                    data = [
-                        tuple(
-                            None if isinstance(x, float) and math.isnan(x) else x
-                            for x in row
-                        )
-                        for row in data
-                    ]
                 
                 if conflict_key != None:                    
-                    conflict_set = ','.join(str(e) for e in df.columns)
-                    excluded_set = ','.join('EXCLUDED.' + str(e) for e in df.columns)
-                    if isinstance(conflict_key,list):
-                        conflict_key = ','.join(str(e) for e in conflict_key)
+                    if isinstance(conflict_key,str):
+                        conflict_key = [key.strip() for key in conflict_key.split(',')]
                     match str(conflict_action).lower():
-                        case 'update':
+                        case 'update' | 'nothing':
                             try:
-                                INSERT_SQL = f"""
-                                    INSERT INTO {schema}.{table_name} ({col_names})
-                                        VALUES ({','.join(['%s'] * len(df.columns))})
-                                        ON CONFLICT ({conflict_key}) DO UPDATE SET ({conflict_set})=({excluded_set})
-                                        ;
-                                """
-                                
-                                cursor.executemany(INSERT_SQL, data)
-                                inserted_rows += cursor.rowcount
-                                
+                                inserted_rows += self.upsert_from_temp_table(
+                                    cursor,
+                                    df,
+                                    f'{schema}.{table_name}',
+                                    conflict_key,
+                                    update=str(conflict_action).lower() == 'update')
                             except Exception as e:
-                                #print(values,INSERT_SQL)
                                 print('EXCEPTION PGLIBS:',e)
                                 raise e
-                        case 'nothing':
-                                INSERT_SQL = f"""
-                                    INSERT INTO {schema}.{table_name} ({col_names})
-                                        VALUES %s
-                                    ON CONFLICT 
-                                        ({conflict_key}) 
-                                    DO NOTHING """
-                                execute_values(
-                                        cursor, 
-                                        INSERT_SQL, 
-                                        data, 
-                                        template=None, 
-                                        page_size=10000)
-                                self.execution_metrics['inserted_rows'] += cursor.rowcount
                 else:
-                    INSERT_SQL = f"""
-                        INSERT INTO {schema}.{table_name} ({col_names})
-                            VALUES %s
-                        """
-                    execute_values(cursor, 
-                                    INSERT_SQL, 
-                                    data, 
-                                    template=None, 
-                                    page_size=10000)
-                    self.execution_metrics['inserted_rows'] += cursor.rowcount
+                    self.copy_into(cursor,df,f'{schema}.{table_name}')
+                    inserted_rows += len(df)
             
             cursor.execute('COMMIT;')
             #connection.commit()   
@@ -286,8 +516,6 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                 update_where_clause2 += 'ods.' +conflict_key+' = '+'stg.'+conflict_key
                 bulk_insert_where_clause += 'ods1.' +conflict_key+' IS NULL'
 
-            data = [tuple(x) for x in df.values]
-            col_names = ','.join(str(e) for e in df.columns)
             update_set = ''
             index = 0
             for col in df.columns:
@@ -297,19 +525,12 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                 index += 1
             
             # save data in staging table
-            INSERT_SQL = f"""INSERT INTO 
-                {self.staging_schema}.{self.staging_table} ({col_names})
-                VALUES %s """
-            total_bulk = len(data)
-            self.logger.info(f'Bulk insert {total_bulk} records')
-
-            execute_values(
-                    cursor, 
-                    INSERT_SQL, 
-                    data, 
-                    template=None, 
-                    page_size=10000)
-            self.execution_metrics['staged_rows'] += cursor.rowcount
+            total_bulk = len(df)
+            self.logger.info(f'COPY {total_bulk} records into staging table')
+            self.execution_metrics['staged_rows'] += self.copy_into(
+                cursor,
+                df,
+                f'{self.staging_schema}.{self.staging_table}')
             # update
             # TODO REMOVE THIS URGENTLY
             update_where_clause = 'ods1.brdr_data_md5 is not null and stg.brdr_data_md5 != ods1.brdr_data_md5'
@@ -8,6 +8,156 @@ import pandas
 from sqlalchemy.sql import text
 from psycopg2 import Timestamp
 import psycopg2
+import uuid
+import os
+import csv
+import json
+import math
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+COPY_FORMATS = ('parquet','csv')
+
+def file_row_ranges(total_rows:int,slices:int,max_rows_per_file:int)->list:
+    """
+    [(start, stop)] row ranges of the COPY files of a chunk. The file
+    count is a multiple of the cluster slices, so every slice loads the
+    same number of similarly sized files.
+    """
+    if total_rows <= 0:
+        return []
+    slices = max(int(slices or 1),1)
+    max_rows_per_file = max(int(max_rows_per_file or 1),1)
+    files = slices * max(math.ceil(total_rows / (slices * max_rows_per_file)),1)
+    files = min(files,total_rows)
+    bounds = [total_rows * i // files for i in range(files + 1)]
+    return [(start,stop) for start,stop in zip(bounds[:-1],bounds[1:]) if stop > start]
+
+def redshift_arrow_type(sql_type:str)->pa.DataType|None:
+    """Parquet (arrow) type COPY expects for a reflected redshift column type, None if unknown."""
+    name = str(sql_type).upper().strip()
+    match = re.match(r'(NUMERIC|DECIMAL)\s*(?:\(\s*(\d+)\s*(?:,\s*(\d+))?\s*\))?',name)
+    if match:
+        return pa.decimal128(int(match.group(2) or 18),int(match.group(3) or 0))
+    if name.startswith('TIMESTAMP'):
+        with_tz = 'WITH TIME ZONE' in name or name.startswith('TIMESTAMPTZ')
+        return pa.timestamp('us',tz='UTC' if with_tz else None)
+    for prefix,arrow_type in (
+            ('SMALLINT',pa.int16()),
+            ('BIGINT',pa.int64()),
+            ('INT',pa.int32()),
+            ('REAL',pa.float32()),
+            ('DOUBLE',pa.float64()),
+            ('FLOAT',pa.float64()),
+            ('BOOL',pa.bool_()),
+            ('DATE',pa.date32()),
+            ('VARCHAR',pa.string()),
+            ('CHAR',pa.string()),
+            ('TEXT',pa.string())):
+        if name.startswith(prefix):
+            return arrow_type
+    return None
+
+def copy_parquet_table(df:pandas.DataFrame,column_types:dict)->pa.Table:
+    """
+    Arrow table of df with every column cast to the type of the staging
+    column (column_types: name -> sql type), so COPY FORMAT PARQUET does
+    not reject int64 for INT4, NaN floats for nullable ints or null
+    typed all-None columns.
+    """
+    arrays = []
+    for col in df.columns:
+        try:
+            array = pa.array(df[col],from_pandas=True)
+        except (pa.ArrowInvalid,pa.ArrowTypeError):
+            array = pa.array(
+                [None if pandas.isna(value) else str(value) for value in df[col]],
+                type=pa.string())
+        target = redshift_arrow_type(column_types.get(str(col).lower(),''))
+        if target is not None and array.type != target:
+            try:
+                # timestamps to dates drop the time of day
+                array = array.cast(target,safe=not pa.types.is_date(target))
+            except (pa.ArrowInvalid,pa.ArrowNotImplementedError) as e:
+                raise ValueError(
+                    f'Column {col} ({array.type}) can not be written as {column_types[str(col).lower()]} for COPY: {e}')
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays,names=[str(col) for col in df.columns])
+
+def build_copy_manifest(entries:list)->dict:
+    """COPY manifest of [(url, content_length)]; parquet needs content_length."""
+    return {
+        'entries':[
+            {'url':url,'mandatory':True,'meta':{'content_length':int(content_length)}}
+            for url,content_length in entries
+        ]
+    }
+
+def build_copy_sql(
+        table:str,
+        manifest_url:str,
+        columns:list=None,
+        copy_format:str='parquet',
+        iam_role:str=None,
+        region:str=None)->str:
+    """COPY ... MANIFEST statement loading the files of manifest_url into table."""
+    copy_format = str(copy_format).lower()
+    if copy_format not in COPY_FORMATS:
+        raise ValueError(f'Invalid copy_format {copy_format}, use one of {list(COPY_FORMATS)}')
+    # columnar files are matched by position, no column list
+    column_list = f" ({','.join(columns)})" if columns and copy_format == 'csv' else ''
+    sql = f"COPY {table}{column_list} FROM '{manifest_url}'"
+    if iam_role:
+        sql += f" IAM_ROLE '{iam_role}'"
+    if region:
+        sql += f" REGION '{region}'"
+    if copy_format == 'parquet':
+        sql += ' FORMAT AS PARQUET'
+    else:
+        # nulls are written as \N, the COPY default
+        sql += " FORMAT AS CSV GZIP TIMEFORMAT 'auto' DATEFORMAT 'auto'"
+    return sql + ' MANIFEST'
+
+def build_merge_sql(
+        schema:str,
+        table_name:str,
+        staging:str,
+        columns:list,
+        conflict_key:list|str,
+        conflict_action:str=None)->list:
+    """
+    Statements applying the staging table to schema.table_name: an
+    UPDATE of the matching rows when conflict_action is update, then an
+    INSERT of the rows without a match.
+    """
+    if not isinstance(conflict_key,list):
+        conflict_key = [conflict_key]
+    join_key = ' AND \n'.join(f'ods1.{key} = stg.{key}' for key in conflict_key)
+    update_where_clause = join_key
+    update_where_clause2 = ' AND \n'.join(f'ods.{key} = stg.{key}' for key in conflict_key)
+    bulk_insert_where_clause = ' AND \n'.join(f'ods1.{key} IS NULL' for key in conflict_key)
+    update_set = ',\n'.join(f'{col} = stg.{col}' for col in columns)
+    statements = []
+    if str(conflict_action).upper() == 'UPDATE':
+        statements.append(f"""
+                    UPDATE {schema}.{table_name} ods SET {update_set}
+                    FROM (SELECT stg.* FROM  {staging} stg  
+                        LEFT JOIN {schema}.{table_name} ods1 
+                        ON {join_key} 
+                        WHERE {update_where_clause}) as stg
+                    WHERE {update_where_clause2}
+                """)
+    statements.append(f"""
+                INSERT INTO {schema}.{table_name}
+                (SELECT stg.* FROM {staging} stg
+                    LEFT JOIN {schema}.{table_name} ods1 
+                    ON {join_key} WHERE {bulk_insert_where_clause})
+            """)
+    return statements
 
 class RedshiftBackend(conn_abstract.DatabaseBackend):
     def __init__(self,*args,**kwargs):
@@ -24,6 +174,16 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
         self.staging_schema = kwargs.get('staging_schema','staging')
         self.staging_table = kwargs.get('staging_table',None)
         self.execution_metrics['staged_rows'] = 0
+        # staging fill: insert (execute_values) or copy (files + COPY MANIFEST)
+        self.staging_load = str(kwargs.get('staging_load','insert')).lower()
+        self.copy_storage_root = kwargs.get('copy_storage_root',None)
+        self.copy_prefix = str(kwargs.get('copy_prefix','borderliner/redshift')).strip('/')
+        self.copy_format = str(kwargs.get('copy_format','parquet')).lower()
+        self.copy_iam_role = kwargs.get('copy_iam_role',None)
+        self.copy_region = kwargs.get('copy_region',None)
+        self.copy_rows_per_file = int(kwargs.get('copy_rows_per_file',500000))
+        self.copy_upload_workers = int(kwargs.get('copy_upload_workers',8))
+        self.slice_count:int = None
 
     @staticmethod
     def _sql_type_name(col_type):
@@ -52,6 +212,8 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
     
     def table_exists(self,table_name, schema):
         try:
+            if self.get_schema_cache().has_table(schema,table_name):
+                return True
             conn = self.engine.raw_connection()
             query = f"SELECT table_name FROM information_schema.tables WHERE table_name = '{table_name}' AND table_schema = '{schema}'"
             cur = conn.cursor()
@@ -63,6 +225,15 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
             print(f"Error checking table existence: {e}")
             return False
 
+    def get_streaming_cursor(self,connection,fetch_size:int=10000):
+        """
+        Named (server-side) cursor, so psycopg2 fetches the result set
+        in blocks of fetch_size rows instead of loading it all at once.
+        """
+        cursor = connection.cursor(name=f'brdr_{uuid.uuid4().hex}')
+        cursor.itersize = fetch_size
+        return cursor
+
     #@staticmethod
     def column_exists_db(
         self,
@@ -70,13 +241,17 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
         table_name, 
         column_name, 
         dtype, 
-        if_not_exists='append'):
+        if_not_exists='append',
+        schema=None):
         """
         Check if colunm exists on db.
 
         @TODO: This only works with postgres databases. Need a method 
         for all attended databases types.
         """
+        schema_cache = self.get_schema_cache()
+        if schema_cache.has_column(schema,table_name,column_name):
+            return 0
         q = f"SELECT count(*) FROM information_schema.columns " \
             f"where table_name = '{table_name}' and column_name = '{column_name}'"
         conn = active_connection
@@ -87,6 +262,7 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
                 dt = RedshiftBackend._sql_type_name(dtype.__str__())
                 qc = f"ALTER TABLE {table_name} ADD COLUMN {column_name.lower()} {dt}"
                 conn.execute(qc)
+                schema_cache.invalidate(schema,table_name)
                 #active_connection.commit()
                 #self.logger.log(self.logger.CRITICAL, ("%s column didn't existed in the %s. Added." % (column_name, table_name)))
                 return 0
@@ -98,6 +274,109 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
             print('COL EXISTS EXCEPTION',e)
             raise e
 
+    def get_slice_count(self,cursor)->int:
+        if self.slice_count is None:
+            cursor.execute('SELECT COUNT(*) FROM stv_slices')
+            self.slice_count = max(int(cursor.fetchone()[0]),1)
+            self.logger.info(f'Redshift cluster slices: {self.slice_count}')
+        return self.slice_count
+
+    def write_copy_files(self,df:pandas.DataFrame,directory:str,slices:int,column_types:dict=None)->list:
+        """
+        Writes df as COPY files in directory, returns the local paths.
+        Parquet columns are cast to column_types (staging table types).
+        """
+        files = []
+        for i,(start,stop) in enumerate(file_row_ranges(len(df),slices,self.copy_rows_per_file)):
+            part = df.iloc[start:stop]
+            if self.copy_format == 'parquet':
+                filename = os.path.join(directory,f'part_{i:05d}.parquet')
+                pq.write_table(
+                    copy_parquet_table(part,column_types or {}),
+                    filename,
+                    coerce_timestamps='us',
+                    allow_truncated_timestamps=True)
+            else:
+                filename = os.path.join(directory,f'part_{i:05d}.csv.gz')
+                part.to_csv(
+                    filename,
+                    index=False,
+                    header=False,
+                    na_rep='\\N',
+                    quoting=csv.QUOTE_MINIMAL,
+                    compression='gzip')
+            files.append(filename)
+        return files
+
+    def upload_copy_files(self,files:list,key_prefix:str)->list:
+        """Uploads files in parallel, returns [(url, content_length)]."""
+        environment = self.environment
+        def _upload(filename):
+            object_name = f'{key_prefix}/{os.path.basename(filename)}'
+            if environment.upload_file_to_storage(filename,self.copy_storage_root,object_name) is False:
+                raise Exception(f'Upload of {filename} to {self.copy_storage_root} failed')
+            return f's3://{self.copy_storage_root}/{object_name}',os.path.getsize(filename)
+        workers = max(min(self.copy_upload_workers,len(files)),1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_upload,files))
+
+    def copy_into_staging(self,cursor,df:pandas.DataFrame,staging:str)->int:
+        """
+        Fills the staging table through storage: df is written as files
+        (a multiple of the cluster slices), uploaded in parallel, listed
+        in a manifest and loaded with a single COPY ... MANIFEST.
+        """
+        if self.environment is None or not self.copy_storage_root:
+            raise ValueError('staging_load copy needs a cloud environment and copy_storage_root')
+        column_types = {}
+        if self.copy_format == 'parquet':
+            # parquet columns are matched by position
+            column_types = self.get_schema_cache().columns(self.staging_schema,self.staging_table)
+            staging_columns = list(column_types)
+            if staging_columns:
+                by_name = {str(col).lower():col for col in df.columns}
+                df = pandas.DataFrame({
+                    col:(df[by_name[col]] if col in by_name else None)
+                    for col in staging_columns
+                },index=df.index)
+        directory = tempfile.mkdtemp(prefix='brdr_redshift_')
+        key_prefix = f'{self.copy_prefix}/{uuid.uuid4().hex}'
+        object_names = []
+        try:
+            files = self.write_copy_files(df,directory,self.get_slice_count(cursor),column_types)
+            object_names = [
+                f'{key_prefix}/{os.path.basename(filename)}'
+                for filename in files + ['manifest.json']
+            ]
+            entries = self.upload_copy_files(files,key_prefix)
+            manifest_file = os.path.join(directory,'manifest.json')
+            with open(manifest_file,'w') as f:
+                json.dump(build_copy_manifest(entries),f)
+            manifest_url = self.upload_copy_files([manifest_file],key_prefix)[0][0]
+            copy_sql = build_copy_sql(
+                staging,
+                manifest_url,
+                columns=[str(col) for col in df.columns],
+                copy_format=self.copy_format,
+                iam_role=self.copy_iam_role,
+                region=self.copy_region)
+            self.logger.info(f'COPY {len(df)} rows in {len(files)} files from {manifest_url}')
+            cursor.execute(copy_sql)
+            return len(df)
+        finally:
+            shutil.rmtree(directory,ignore_errors=True)
+            self.delete_copy_files(object_names)
+
+    def delete_copy_files(self,object_names:list):
+        """Removes the uploaded COPY files and manifest from the bucket."""
+        if not object_names:
+            return
+        def _delete(object_name):
+            self.environment.delete_file_from_storage(self.copy_storage_root,object_name)
+        workers = max(min(self.copy_upload_workers,len(object_names)),1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_delete,object_names))
+
     def insert_on_conflict(
         self, 
         active_connection:Engine,
@@ -120,80 +399,40 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
             truncate_staging_statement = f'TRUNCATE TABLE {self.staging_schema}.{self.staging_table};'
             self.logger.info(f'Truncating {self.staging_schema}.{self.staging_table}')
             cursor.execute(truncate_staging_statement)
-            join_key = ''
-            update_where_clause = ''
-            update_where_clause2 = ''
-            bulk_insert_where_clause = ''
-            if isinstance(conflict_key,list):
-                index = 0
-                for key in conflict_key:
-                    join_key += 'ods1.' +str(key)+' = '+'stg.'+key 
-                    update_where_clause += 'ods1.' +str(key)+' = '+'stg.'+key
-                    update_where_clause2 += 'ods.' +str(key)+' = '+'stg.'+key
-                    bulk_insert_where_clause += 'ods1.' +str(key)+' IS NULL'
-                    if index+1 < len(conflict_key):
-                        join_key += ' AND \n' 
-                        update_where_clause += ' AND \n'
-                        update_where_clause2 += ' AND \n'
-                        bulk_insert_where_clause += ' AND \n'
-                    index += 1
-
-                conflict_key = ','.join(str(e) for e in conflict_key)
+            staging = f'{self.staging_schema}.{self.staging_table}'
+            if self.staging_load == 'copy':
+                self.execution_metrics['staged_rows'] += self.copy_into_staging(cursor,df,staging)
             else:
-                join_key = 'ods1.'+conflict_key+' = '+'stg.'+conflict_key
-                update_where_clause += 'ods1.' +conflict_key+' = '+'stg.'+conflict_key
-                update_where_clause2 += 'ods.' +conflict_key+' = '+'stg.'+conflict_key
-                bulk_insert_where_clause += 'ods1.' +conflict_key+' IS NULL'
-
-            data = [tuple(x) for x in df.values]
-            col_names = ','.join(str(e) for e in df.columns)
-            update_set = ''
-            index = 0
-            for col in df.columns:
-                update_set += str(col) + ' = ' + 'stg.' + col 
-                if index+1 < len(df.columns):
-                        update_set += ',\n' 
-                index += 1
-            
-            # save data in staging table
-            INSERT_SQL = f"""INSERT INTO 
-                {self.staging_schema}.{self.staging_table} ({col_names})
-                VALUES %s """
-            total_bulk = len(data)
-            self.logger.info(f'Bulk insert {total_bulk} records')
-            execute_values(
-                    cursor, 
-                    INSERT_SQL, 
-                    data, 
-                    template=None, 
-                    page_size=10000)
-            self.execution_metrics['staged_rows'] += cursor.rowcount
+                data = [tuple(x) for x in df.values]
+                col_names = ','.join(str(e) for e in df.columns)
+                # save data in staging table
+                INSERT_SQL = f"""INSERT INTO 
+                    {staging} ({col_names})
+                    VALUES %s """
+                total_bulk = len(data)
+                self.logger.info(f'Bulk insert {total_bulk} records')
+                execute_values(
+                        cursor, 
+                        INSERT_SQL, 
+                        data, 
+                        template=None, 
+                        page_size=10000)
+                self.execution_metrics['staged_rows'] += cursor.rowcount
+            statements = build_merge_sql(
+                schema,
+                table_name,
+                staging,
+                [str(col) for col in df.columns],
+                conflict_key,
+                conflict_action)
             # update
-            if str(conflict_action).upper() == 'UPDATE':
-                UPDATE_SQL = f"""
-                    UPDATE {schema}.{table_name} ods SET {update_set}
-                    FROM (SELECT stg.* FROM  {self.staging_schema}.{self.staging_table} stg  
-                        LEFT JOIN {schema}.{table_name} ods1 
-                        ON {join_key} 
-                        WHERE {update_where_clause}) as stg
-                    WHERE {update_where_clause2}
-                """
-                
+            if len(statements) > 1:
                 self.logger.info('Performing updates.')
-                cursor.execute(UPDATE_SQL)
-                
+                cursor.execute(statements[0])
                 self.execution_metrics['updated_rows'] += cursor.rowcount
 
-            BULK_INSERT_SQL = f"""
-                INSERT INTO {schema}.{table_name}
-                (SELECT stg.* FROM {self.staging_schema}.{self.staging_table} stg
-                    LEFT JOIN {schema}.{table_name} ods1 
-                    ON {join_key} WHERE {bulk_insert_where_clause})
-            """
-
-            #print(BULK_INSERT_SQL)
             self.logger.info('Moving data from staging to ods.')
-            cursor.execute(BULK_INSERT_SQL)
+            cursor.execute(statements[-1])
             self.execution_metrics['inserted_rows'] += cursor.rowcount
             connection.commit()                                
             cursor.close()
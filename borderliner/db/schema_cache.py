@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+
+# logging
+from borderliner.core.logs import get_logger
+logger = get_logger()
+
+def _normalize(name)->str:
+    return str(name).strip('"').lower()
+
+class SchemaCache:
+    """
+    Table metadata (columns and types, primary key, unique indexes) read
+    once per table through the SQLAlchemy inspector, instead of one
+    catalog query per column and chunk.
+
+    Entries are only dropped by invalidate(), which backends call after
+    they run an ALTER TABLE. With persist_path the cache is kept in a
+    JSON file across runs; a persisted entry is used only if the column
+    list of a `SELECT * ... WHERE 1=0` on the table still matches it.
+    """
+    def __init__(self,engine:Engine,persist_path:str=None) -> None:
+        self.logger = logger
+        self.engine = engine
+        self.persist_path = persist_path
+        self.tables = {}
+        self.persisted = {}
+        self._lock = threading.Lock()
+        if persist_path and os.path.exists(persist_path):
+            try:
+                with open(persist_path,'r') as f:
+                    self.persisted = json.load(f)
+            except (OSError,ValueError):
+                self.persisted = {}
+
+    def _key(self,schema,table_name)->str:
+        url = self.engine.url.render_as_string(hide_password=True)
+        return f'{url}|{schema or ""}.{_normalize(table_name)}'
+
+    def _select_columns(self,schema,table_name)->list|None:
+        table = f'{schema}.{table_name}' if schema else table_name
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f'SELECT * FROM {table} WHERE 1=0')
+            columns = [_normalize(col[0]) for col in cursor.description]
+            cursor.close()
+            return columns
+        except Exception:
+            return None
+        finally:
+            try:
+                connection.rollback()
+            except Exception:
+                pass
+            connection.close()
+
+    def _reflect(self,schema,table_name)->dict:
+        inspector = inspect(self.engine)
+        if not inspector.has_table(table_name,schema=schema):
+            return {'exists':False,'columns':{},'primary_key':[],'unique':[]}
+        columns = {
+            _normalize(col['name']):str(col['type'])
+            for col in inspector.get_columns(table_name,schema=schema)
+        }
+        primary_key = inspector.get_pk_constraint(table_name,schema=schema) or {}
+        unique = []
+        try:
+            unique += [
+                [_normalize(col) for col in constraint['column_names']]
+                for constraint in inspector.get_unique_constraints(table_name,schema=schema)
+            ]
+        except NotImplementedError:
+            pass
+        unique += [
+            [_normalize(col) for col in index['column_names'] if col]
+            for index in inspector.get_indexes(table_name,schema=schema)
+            if index.get('unique')
+        ]
+        self.logger.info(f'Schema cache loaded {schema}.{table_name}: {len(columns)} columns')
+        return {
+            'exists':True,
+            'columns':columns,
+            'primary_key':[_normalize(col) for col in primary_key.get('constrained_columns',[]) or []],
+            'unique':unique
+        }
+
+    def get(self,schema,table_name)->dict:
+        """{'exists','columns':{name:type},'primary_key':[...],'unique':[[...]]}"""
+        key = self._key(schema,table_name)
+        with self._lock:
+            if key in self.tables:
+                return self.tables[key]
+            entry = self.persisted.get(key,None)
+            if entry is not None and entry.get('exists'):
+                if self._select_columns(schema,table_name) != list(entry['columns'].keys()):
+                    entry = None
+            elif entry is not None:
+                entry = None
+            if entry is None:
+                entry = self._reflect(schema,table_name)
+            if entry['exists']:
+                # missing tables are looked up again, borderliner may create them
+                self.tables[key] = entry
+                self._save()
+            return entry
+
+    def has_table(self,schema,table_name)->bool:
+        return self.get(schema,table_name)['exists']
+
+    def has_column(self,schema,table_name,column_name)->bool:
+        return _normalize(column_name) in self.get(schema,table_name)['columns']
+
+    def columns(self,schema,table_name)->dict:
+        return self.get(schema,table_name)['columns']
+
+    def primary_key(self,schema,table_name)->list:
+        return self.get(schema,table_name)['primary_key']
+
+    def invalidate(self,schema,table_name):
+        """Forgets table_name; call after altering it."""
+        key = self._key(schema,table_name)
+        with self._lock:
+            self.tables.pop(key,None)
+            self.persisted.pop(key,None)
+            self._save()
+
+    def _save(self):
+        if not self.persist_path:
+            return
+        data = {**self.persisted,**{key:entry for key,entry in self.tables.items() if entry.get('exists')}}
+        if os.path.dirname(self.persist_path):
+            os.makedirs(os.path.dirname(self.persist_path),exist_ok=True)
+        tmp_path = f'{self.persist_path}.tmp'
+        with open(tmp_path,'w') as f:
+            json.dump(data,f)
+        os.replace(tmp_path,self.persist_path)
@@ -0,0 +1,54 @@
+from borderliner.db.conn_abstract import DatabaseBackend
+
+
+class NamedCursorStub:
+    """Named psycopg2 cursor stand-in: description is None until the first fetch."""
+    def __init__(self,rows:list) -> None:
+        self.rows = list(rows)
+        self.description = None
+        self.fetch_sizes = []
+
+    def execute(self,query):
+        pass
+
+    def fetchmany(self,size):
+        self.description = (('id',),('name',))
+        self.fetch_sizes.append(size)
+        rows,self.rows = self.rows[:size],self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class ConnectionStub:
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamingBackendStub(DatabaseBackend):
+    def __init__(self,cursor:NamedCursorStub) -> None:
+        self.cursor = cursor
+
+    def get_raw_connection(self):
+        return ConnectionStub()
+
+    def get_streaming_cursor(self,connection,fetch_size:int=10000):
+        return self.cursor
+
+
+def test_stream_query_reads_description_after_first_fetch():
+    cursor = NamedCursorStub([(i,f'row {i}') for i in range(23)])
+    backend = StreamingBackendStub(cursor)
+    chunks = list(backend.stream_query('SELECT id, name FROM t',chunk_size=10,fetch_size=4))
+    assert [len(df) for df in chunks] == [10,10,3]
+    assert list(chunks[0].columns) == ['id','name']
+    assert set(cursor.fetch_sizes) == {4}
+
+
+def test_stream_query_empty_result():
+    backend = StreamingBackendStub(NamedCursorStub([]))
+    assert list(backend.stream_query('SELECT id, name FROM t',chunk_size=10)) == []